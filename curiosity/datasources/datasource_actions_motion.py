@@ -5,8 +5,13 @@ import numpy as np
 import h5py
 import json
 import zmq
+import argparse
+import threading
+from multiprocessing.pool import ThreadPool
 
-from curiosity.utils.io import (handle_sock,
+from curiosity.utils.io import (recv_message,
+                                decode_image,
+                                write_message,
                                 send_array, 
                                 recv_array)
 
@@ -17,46 +22,87 @@ achoice = [-5, 0, 5]
 ACTION_LENGTH = 15
 ACTION_WAIT = 15
 
+N = 1024000
 
 ctx = zmq.Context()
-sock = ctx.socket(zmq.REQ)
-
-print("connecting...")
-sock.connect("tcp://18.93.5.202:23044")
-print("...connected")
-sock.send(json.dumps({'n': 4, 'msg': {"msg_type": "CLIENT_JOIN"}}))
-print("...joined")
+path = None
+infodir = None
+file = None
+valid = None
+images = None
+normals = None
+objects = None
+pool = None
 
-print('creating sock2 ...')
-sock2 = ctx.socket(zmq.REP)
-sock2.bind('tcp://18.93.3.135:23044')
-print('... bound')
 
-N = 1024000
+class Simulator(object):
+    """
+    Connection to one simulator instance, which fills the batches in
+    [bn_start, bn_end) of the HDF5 file.  The lock serializes use of the
+    REQ socket between the background filler and on-demand requests.
+    """
+    def __init__(self, address, seed, bn_start, bn_end):
+        self.sock = ctx.socket(zmq.REQ)
+        print("connecting to %s..." % address)
+        self.sock.connect(address)
+        print("...connected")
+        self.sock.send(json.dumps({'n': 4, 'msg': {"msg_type": "CLIENT_JOIN"}}))
+        print("...joined")
+        self.rng = np.random.RandomState(seed)
+        self.bn_start = bn_start
+        self.bn_end = bn_end
+        self.lock = threading.Lock()
 
-path = '/data2/datasource6'
-infodir = path + '_info'
-if not os.path.exists(infodir):
-    os.makedirs(infodir)
 
-file = h5py.File(path, mode='a')
-valid = file.require_dataset('valid', shape=(N,), dtype=np.bool)
-images = file.require_dataset('images', shape=(N, 256, 256, 3), dtype=np.uint8)
-normals = file.require_dataset('normals', shape=(N, 256, 256, 3), dtype=np.uint8)
-objects = file.require_dataset('objects', shape=(N, 256, 256, 3), dtype=np.uint8)
+def initialize(datapath, num_workers):
+    global path, infodir, file, valid, images, normals, objects, pool
+    path = datapath
+    infodir = path + '_info'
+    if not os.path.exists(infodir):
+        os.makedirs(infodir)
+    file = h5py.File(path, mode='a')
+    valid = file.require_dataset('valid', shape=(N,), dtype=np.bool)
+    images = file.require_dataset('images', shape=(N, 256, 256, 3), dtype=np.uint8)
+    normals = file.require_dataset('normals', shape=(N, 256, 256, 3), dtype=np.uint8)
+    objects = file.require_dataset('objects', shape=(N, 256, 256, 3), dtype=np.uint8)
+    pool = ThreadPool(num_workers)
 
-rng = np.random.RandomState(0)
 
-def choose(x):
+def choose(x, rng):
   return x[rng.randint(len(x))]
 
-def choose_action_position(objarray):
+def choose_action_position(objarray, rng):
   xs, ys = (objarray > 2).nonzero()
   pos = zip(xs, ys)
   return pos[rng.randint(len(pos))]
 
 
-def make_new_batch(bn):
+def decode_and_write(info, nstr, ostr, imstr, prefix):
+    """decodes the image and normals of a frame and writes it all to disk"""
+    write_message(info, nstr, ostr, imstr, outdir=path + '_ims', prefix=prefix)
+    return decode_image(imstr), decode_image(nstr)
+
+
+def get_simulator(sims, bn):
+    for sim in sims:
+        if sim.bn_start <= bn < sim.bn_end:
+            return sim
+    return sims[-1]
+
+
+def make_new_batch(bn, sim):
+    with sim.lock:
+        make_new_batch_locked(bn, sim)
+
+
+def make_new_batch_locked(bn, sim):
+    """
+    Drives sim through one batch of frames.  Only the object-ID image is
+    decoded here, since the control policy needs it; decoding the image and
+    normals and writing the frame to disk happen on the worker pool.
+    """
+    sock = sim.sock
+    rng = sim.rng
     action_length = ACTION_LENGTH #(bsize - i) / 3
     action_wait = ACTION_WAIT
 
@@ -65,15 +111,14 @@ def make_new_batch(bn):
     end = BATCH_SIZE * (bn + 1)
     if not valid[start: end].all():
         print("Getting new %d-%d" % (start, end))
-        ims = []
+        decoded = []
         objs = []
-        norms = []
         infolist = []
         for i in range(bsize):
-            print(i)
-            info, narray, oarray, imarray = handle_message(sock, 
-                                                           write=True, 
-                                                           outdir=path + '_ims', prefix=str(i))
+            info, nstr, ostr, imstr = recv_message(sock)
+            decoded.append(pool.apply_async(decode_and_write,
+                                            (info, nstr, ostr, imstr, '%d_%d' % (bn, i))))
+            oarray = decode_image(ostr)
             msg = {'n': 4,
                    'msg': {"msg_type": "CLIENT_INPUT",
                            "get_obj_data": False,
@@ -95,7 +140,8 @@ def make_new_batch(bn):
                 amult = MULTSTART
             else:
                 oarray1 = 256**2 * oarray[:, :, 0] + 256 * oarray[:, :, 1] + oarray[:, :, 2]
-                obs = np.unique(oarray1)
+                obs, counts = np.unique(oarray1, return_counts=True)
+                fracs = counts[obs > 2] / float(np.prod(oarray.shape))
                 obs = obs[obs > 2]
                 if len(obs) == 0:
                     print('turning at %d ... ' % i)
@@ -110,10 +156,6 @@ def make_new_batch(bn):
                     chosen = False
                     g = 7.5 * (2 * rng.uniform() - 1)
                 else:
-                    fracs = []
-                    for o in obs:
-                        frac = (oarray1 == o).sum() / float(np.prod(oarray.shape))
-                        fracs.append(frac)
                     if not chosen or (chosen_o not in obs and ((not action_started) or action_done)):
                         action_started = False
                         action_done = False
@@ -121,7 +163,7 @@ def make_new_batch(bn):
                         objpi = []
                         aset = achoice[:]
                         amult = MULTSTART
-                        chosen_o = choose(obs[np.argsort(fracs)[-10:]])
+                        chosen_o = choose(obs[np.argsort(fracs)[-10:]], rng)
                         chosen = True
                         print('Choosing object', chosen_o)
                         g = 15. * (2 * rng.uniform() - 1)
@@ -188,10 +230,9 @@ def make_new_batch(bn):
                             action['action_pos'] = map(float, pos)
                         msg['msg']['actions'].append(action)
             infolist.append(msg['msg'])
-            ims.append(imarray)
-            norms.append(narray)
             objs.append(oarray)
             sock.send_json(msg)
+        ims, norms = zip(*[r.get() for r in decoded])
         ims = np.array(ims)
         norms = np.array(norms)
         objs = np.array(objs)
@@ -207,43 +248,82 @@ def make_new_batch(bn):
     file.flush()
 
 
-while True:
-    msg = sock2.recv_json()
-    print(msg)
-    if msg.get('command') == 'get_valid':
-        va = np.asarray(valid)
-        undone = (va == 0).nonzero()[0]
-        if len(undone) > 0:
-            bn = undone[0] / BATCH_SIZE
-            make_new_batch(bn)
-        va = np.asarray(valid).nonzero()[0]
-        batches = np.unique(np.floor(va / BATCH_SIZE)).astype(np.int)
-        send_array(sock2, batches)
-    elif msg.get('command') == 'get_info':
-        bn = 0
-        make_new_batch(bn)
-        infopath = os.path.join(infodir, str(bn) + '.json')
-        infolist = json.loads(open(infopath).read())
-        msg = {'info': infolist[1],
-               'image_size': 256,
-               'num_channels': 3}
-        sock2.send_json(msg)
-    else:      
-        bn = msg['batch_num']
-        bsize = BATCH_SIZE
-        start = (bn * bsize) % N
-        end = ((bn + 1) * bsize - 1) % N + 1
-        make_new_batch(bn)
-
-        print("Sending batch %d" % bn)
-        ims = images[start: end] 
-        norms = normals[start: end] 
-        objs = objects[start: end]
-        infopath = os.path.join(infodir, str(bn) + '.json')
-        infolist = json.loads(open(infopath).read())
-        sock2.send_json(infolist, flags=zmq.SNDMORE)
-        send_array(sock2, ims, flags=zmq.SNDMORE)
-        send_array(sock2, norms, flags=zmq.SNDMORE)
-        send_array(sock2, objs)
-    
 
+def fill(sim):
+    """generates every batch in the simulator's range that is not yet valid"""
+    for bn in range(sim.bn_start, sim.bn_end):
+        make_new_batch(bn, sim)
+
+
+def main(sim_addresses, bind_address, datapath, num_workers=4, fill_background=False):
+    initialize(datapath, num_workers)
+    num_batches = N // BATCH_SIZE
+    sims = []
+    for ind, address in enumerate(sim_addresses):
+        bn_start = ind * num_batches // len(sim_addresses)
+        bn_end = (ind + 1) * num_batches // len(sim_addresses)
+        sims.append(Simulator(address, ind, bn_start, bn_end))
+    if fill_background:
+        for sim in sims:
+            t = threading.Thread(target=fill, args=(sim,))
+            t.daemon = True
+            t.start()
+
+    print('creating sock2 ...')
+    sock2 = ctx.socket(zmq.REP)
+    sock2.bind(bind_address)
+    print('... bound')
+
+    while True:
+        msg = sock2.recv_json()
+        print(msg)
+        if msg.get('command') == 'get_valid':
+            va = np.asarray(valid)
+            undone = (va == 0).nonzero()[0]
+            if len(undone) > 0 and not fill_background:
+                bn = undone[0] / BATCH_SIZE
+                make_new_batch(bn, get_simulator(sims, bn))
+            va = np.asarray(valid).nonzero()[0]
+            batches = np.unique(np.floor(va / BATCH_SIZE)).astype(np.int)
+            send_array(sock2, batches)
+        elif msg.get('command') == 'get_info':
+            bn = 0
+            make_new_batch(bn, get_simulator(sims, bn))
+            infopath = os.path.join(infodir, str(bn) + '.json')
+            infolist = json.loads(open(infopath).read())
+            msg = {'info': infolist[1],
+                   'image_size': 256,
+                   'num_channels': 3}
+            sock2.send_json(msg)
+        else:      
+            bn = msg['batch_num']
+            bsize = BATCH_SIZE
+            start = (bn * bsize) % N
+            end = ((bn + 1) * bsize - 1) % N + 1
+            make_new_batch(bn, get_simulator(sims, bn))
+
+            print("Sending batch %d" % bn)
+            ims = images[start: end] 
+            norms = normals[start: end] 
+            objs = objects[start: end]
+            infopath = os.path.join(infodir, str(bn) + '.json')
+            infolist = json.loads(open(infopath).read())
+            sock2.send_json(infolist, flags=zmq.SNDMORE)
+            send_array(sock2, ims, flags=zmq.SNDMORE)
+            send_array(sock2, norms, flags=zmq.SNDMORE)
+            send_array(sock2, objs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sim_addresses', type=str, nargs='+',
+                        default=['tcp://18.93.5.202:23044'],
+                        help="simulator addresses; each fills its own batch range")
+    parser.add_argument('--bind_address', type=str, default='tcp://18.93.3.135:23044')
+    parser.add_argument('--datapath', type=str, default='/data2/datasource6')
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help="threads decoding and writing frames")
+    parser.add_argument('--fill_background', type=int, default=0,
+                        help="keep generating batches while serving")
+    args = vars(parser.parse_args())
+    main(**args)
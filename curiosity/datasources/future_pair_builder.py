@@ -0,0 +1,227 @@
+"""
+Builds the randompermpairs groups read by images_futures_and_actions and
+friends from the frames written by datasource_actions_motion.
+
+Every frame belongs to an episode.  The info of frame i is the message sent
+to the simulator after frame i was received, so a frame flagged
+teleport_random is the last frame of its episode and the next episode starts
+at the frame after it (a new episode also starts wherever the source file
+switches between valid and not yet generated frames).  A pair (i, t) is valid when
+frames i - observation_length + 1 through t all lie in one episode and
+0 < t - i <= max_timediff.  All valid pairs are enumerated once as arrays,
+pairs are drawn from them with a seed (see sample_pairs), and the group is
+written in the order drawn, in blocks:
+  images0   image of frame i
+  images1   image of frame t
+  actions   action vectors of frames i .. i + MAX_NUM_ACTIONS - 1, flattened
+  timediff  t - i
+"""
+from __future__ import print_function
+
+import os
+import json
+import argparse
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+import h5py
+
+from curiosity.datasources.hdf5_repack import read_rows
+
+ATOMIC_ACTION_LENGTH = 14
+MAX_NUM_ACTIONS = 10
+
+
+# (key in the frame info, key in its first action, slice of the action vector)
+ACTION_FIELDS = [('vel', None, slice(0, 3)),
+                 ('ang_vel', None, slice(3, 6)),
+                 (None, 'action_pos', slice(6, 8)),
+                 (None, 'force', slice(8, 11)),
+                 (None, 'torque', slice(11, 14))]
+
+
+def process_actions(info):
+  """
+  Encodes the frames of info as a (len(info), ATOMIC_ACTION_LENGTH) float32
+  array: velocity, angular velocity, and position, force and torque of the
+  frame's first action.  Missing fields and frames (None) are zero.
+  """
+  actions = np.zeros((len(info), ATOMIC_ACTION_LENGTH), dtype=np.float32)
+  for ind, frame in enumerate(info):
+    if frame is None:
+      continue
+    act = frame.get('actions') or [{}]
+    for frame_key, act_key, sl in ACTION_FIELDS:
+      val = frame.get(frame_key) if frame_key else act[0].get(act_key)
+      if val is not None:
+        actions[ind, sl] = val
+  return actions
+
+
+def get_action_windows(actions, num_actions=MAX_NUM_ACTIONS):
+  """
+  Read-only (len(actions), num_actions, ATOMIC_ACTION_LENGTH) view whose
+  window i holds the action vectors of frames i .. i + num_actions - 1, zero
+  past the end.  Indexing it with the frames of a batch gives the action
+  sequences of the batch.
+  """
+  padding = np.zeros((num_actions - 1,) + actions.shape[1:], dtype=actions.dtype)
+  padded = np.concatenate([actions, padding])
+  frame_stride, item_stride = padded.strides
+  windows = as_strided(padded, shape=(len(actions), num_actions, actions.shape[1]),
+                       strides=(frame_stride, frame_stride, item_stride))
+  windows.flags.writeable = False
+  return windows
+
+
+def load_info(datapath, num_frames, batch_size):
+  """
+  Loads the per-frame info saved by datasource_actions_motion in
+  <datapath>_info/<batch_num>.json.  Frames of batches without an info file
+  get None.
+  """
+  info = [None] * num_frames
+  infodir = datapath + '_info'
+  for bn in range(num_frames // batch_size):
+    infopath = os.path.join(infodir, '%d.json' % bn)
+    if os.path.exists(infopath):
+      with open(infopath) as f:
+        info[bn * batch_size: (bn + 1) * batch_size] = json.load(f)
+  return info
+
+
+def get_episode_ids(teleport, valid=None):
+  """
+  Labels each frame with its episode.  The teleport flag of a frame is on the
+  action sent after it, so a new episode starts at the frame following a
+  flagged one, and at each change of valid.
+  """
+  teleport = np.asarray(teleport, dtype=np.bool_)
+  starts = np.zeros(len(teleport), dtype=np.bool_)
+  starts[1:] = teleport[:-1]
+  if valid is not None:
+    valid = np.asarray(valid, dtype=np.bool_)
+    starts[1:] |= valid[1:] != valid[:-1]
+  return np.cumsum(starts)
+
+
+def get_valid_pairs(episode_ids, max_timediff, observation_length=1, valid=None):
+  """
+  Enumerates the valid (i, t) pairs, ordered by i and then t.
+  :param episode_ids: episode label of every frame, see get_episode_ids
+  :param max_timediff: largest allowed t - i
+  :param observation_length: number of frames ending at i that must lie in the episode
+  :param valid: optional mask of the frames that exist
+  :return: arrays of current and future frame indices
+  """
+  n = len(episode_ids)
+  inds, futures = [], []
+  for d in range(1, max_timediff + 1):
+    i = np.arange(observation_length - 1, n - d)
+    ok = episode_ids[i + d] == episode_ids[i]
+    ok &= episode_ids[i - observation_length + 1] == episode_ids[i]
+    if valid is not None:
+      ok &= valid[i]
+    inds.append(i[ok])
+    futures.append(i[ok] + d)
+  inds = np.concatenate(inds)
+  futures = np.concatenate(futures)
+  order = np.lexsort((futures, inds))
+  return inds[order], futures[order]
+
+
+def sample_pairs(inds, num_pairs, rng):
+  """
+  Indices of num_pairs distinct pairs (default all) in the order they are
+  drawn.  Like the rejection sampler this replaces, a draw picks the current
+  frame uniformly and then one of its futures, skipping pairs already drawn,
+  so frames with few valid futures are not underrepresented.
+  :param inds: current frame of every valid pair, see get_valid_pairs
+  :param num_pairs: number of pairs to draw, or None for all
+  :param rng: numpy RandomState
+  :return: indices into inds
+  """
+  n = len(inds)
+  if num_pairs is None:
+    num_pairs = n
+  assert num_pairs <= n, (num_pairs, n)
+  _, inverse, counts = np.unique(inds, return_inverse=True, return_counts=True)
+  # sorting exponential keys scaled by 1 / weight draws without replacement
+  # with probability proportional to weight, here 1 / (futures of the frame)
+  keys = rng.exponential(size=n) * counts[inverse]
+  return np.argsort(keys, kind='mergesort')[:num_pairs]
+
+
+def build(src_path, dst_path, keyname, num_pairs=None, seed=0,
+          max_timediff=MAX_NUM_ACTIONS, source_batch_size=256,
+          image_key='images', future_key='images', block_size=1024):
+  """
+  Writes the group keyname of dst_path (created if needed) from the frames
+  in src_path and their info files.
+  :param src_path: HDF5 file written by datasource_actions_motion
+  :param dst_path: HDF5 file to add the pairs group to, may be src_path
+  :param keyname: name of the group, e.g. 'randompermpairs3_medium'
+  :param num_pairs: number of pairs to write (default all valid pairs)
+  :param seed: seed of the pair order
+  :param max_timediff: largest t - i
+  :param source_batch_size: number of frames per info file
+  :param image_key: dataset images0 is read from
+  :param future_key: dataset images1 is read from
+  :param block_size: number of pairs read and written at a time
+  :return: -
+  """
+  same_file = os.path.abspath(src_path) == os.path.abspath(dst_path)
+  with h5py.File(src_path, mode='a' if same_file else 'r') as src:
+    valid = src['valid'][:]
+    info = load_info(src_path, len(valid), source_batch_size)
+    valid &= np.array([x is not None for x in info])
+    teleport = np.array([bool(x and x.get('teleport_random', False)) for x in info])
+    action_windows = get_action_windows(process_actions(info))
+    episode_ids = get_episode_ids(teleport, valid)
+    inds, futures = get_valid_pairs(episode_ids, max_timediff, valid=valid)
+    print('%d valid pairs in %d frames' % (len(inds), valid.sum()))
+    sel = sample_pairs(inds, num_pairs, np.random.RandomState(seed))
+    inds, futures = inds[sel], futures[sel]
+    n = len(inds)
+
+    images = src[image_key]
+    future_images = src[future_key]
+    dst = src if same_file else h5py.File(dst_path, mode='a')
+    try:
+      group = dst.require_group(keyname)
+      images0 = group.create_dataset('images0', shape=(n,) + images.shape[1:],
+                                     dtype=images.dtype)
+      images1 = group.create_dataset('images1', shape=(n,) + future_images.shape[1:],
+                                     dtype=future_images.dtype)
+      actions = group.create_dataset('actions', shape=(n, MAX_NUM_ACTIONS * ATOMIC_ACTION_LENGTH),
+                                     dtype=np.float32)
+      timediff = group.create_dataset('timediff', shape=(n,), dtype=np.int32)
+      group.attrs['seed'] = seed
+      group.attrs['max_timediff'] = max_timediff
+      for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        i, t = inds[start: end], futures[start: end]
+        images0[start: end] = read_rows(images, i)
+        images1[start: end] = read_rows(future_images, t)
+        actions[start: end] = action_windows[i].reshape(len(i), -1)
+        timediff[start: end] = t - i
+        print('%s: %d / %d' % (keyname, end, n))
+    finally:
+      if not same_file:
+        dst.close()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('src_path', type=str, help="HDF5 file written by datasource_actions_motion")
+  parser.add_argument('dst_path', type=str, help="HDF5 file to write the pairs group to")
+  parser.add_argument('keyname', type=str, help="name of the pairs group")
+  parser.add_argument('--num_pairs', type=int, default=None, help="number of pairs (default all)")
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--max_timediff', type=int, default=MAX_NUM_ACTIONS)
+  parser.add_argument('--source_batch_size', type=int, default=256)
+  parser.add_argument('--image_key', type=str, default='images')
+  parser.add_argument('--future_key', type=str, default='images')
+  parser.add_argument('--block_size', type=int, default=1024)
+  args = vars(parser.parse_args())
+  build(**args)
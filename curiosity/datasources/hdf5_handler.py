@@ -1,11 +1,14 @@
+from __future__ import print_function
+
 import os
-from StringIO import StringIO
-from PIL import Image
 import numpy as np
 import h5py
 import json
 import zmq
 import argparse
+import multiprocessing
+import traceback
+from collections import OrderedDict
 
 from curiosity.utils.io import send_array
 
@@ -25,59 +28,315 @@ def initialize(path):
     print('... on %s' % file.filename)
   else:
     assert path == file.filename, (path, file.filename)
-    print('Already initialized to %s' % file.filename)
 
 
 def rget(f, k):
+  """
+  Gets the dataset at key k, where k is either a name or a list of group
+  names leading down to the dataset, e.g. ['randomperm', 'images'].
+  """
   if isinstance(k, str) or isinstance(k, unicode):
     return f[k]
   else:
     assert isinstance(k, list), k
-    r = dict()
-    for _k in k:
-      r[_k] = f[_k]
-    return r
+    return f['/'.join(k)]
 
-def main(host, port):
-  ctx = zmq.Context()
-  sock2 = ctx.socket(zmq.REP)
-  sockstr = 'tcp://%s:%d' % (host, port)
-  sock2.bind(sockstr)
-  print('Bound to %s' % sockstr)
 
-  while True:
-    msg = sock2.recv_json()
-    print 'Message received! ',
-    # print(msg)
-    initialize(msg['path'])
-    keys = msg['keys']
-    # print keys
-    if 'size' in msg:  # If client asks for size, return only the size
-      send_array(sock2, np.array(rget(file, keys[0]).shape[0]))
-      print 'Sending data size...'
-      continue
+def get_batch_ranges(N, batch_num, batch_size, shuffle_seed=None):
+  """
+  Gets the contiguous row ranges making up a batch.  Batches are laid out
+  back to back, so a batch running past the end of the dataset wraps around
+  to the start and is read as two ranges.  With shuffle_seed, batch order is
+  instead permuted within each epoch of N // batch_size whole batches, with
+  a permutation that depends only on the seed and the epoch.
+  :param N: number of rows in the dataset
+  :param batch_num: index of the batch
+  :param batch_size: number of rows in a batch
+  :param shuffle_seed: seed of the per-epoch batch order, or None
+  :return: list of (start, end) ranges
+  """
+  if shuffle_seed is not None:
+    num_batches = N // batch_size
+    assert num_batches > 0, (N, batch_size)
+    epoch, ind = divmod(batch_num, num_batches)
+    perm = np.random.RandomState([shuffle_seed, epoch]).permutation(num_batches)
+    start = perm[ind] * batch_size
+    return [(start, start + batch_size)]
+  start = (batch_num * batch_size) % N
+  remaining = batch_size
+  ranges = []
+  while remaining > 0:
+    end = min(start + remaining, N)
+    ranges.append((start, end))
+    remaining -= end - start
+    start = 0
+  return ranges
+
+
+def read_ranges(dset, ranges):
+  """
+  Reads the given row ranges of dset into one preallocated array.
+  """
+  n = sum(end - start for start, end in ranges)
+  out = np.empty((n,) + dset.shape[1:], dtype=dset.dtype)
+  pos = 0
+  for start, end in ranges:
+    dset.read_direct(out, np.s_[start: end], np.s_[pos: pos + end - start])
+    pos += end - start
+  return out
+
+
+def get_metadata(f, group=None):
+  """
+  Describes every dataset in f, or under group in it, by its path.
+  :param f: open HDF5 file
+  :param group: key of a group (see rget), or None for the whole file
+  :return: dict from dataset path to its shape, dtype, chunks, compression,
+           compression_opts and length
+  """
+  root = f if group is None else rget(f, group)
+  metadata = {}
+  def describe(name, obj):
+    if isinstance(obj, h5py.Dataset):
+      metadata[obj.name.lstrip('/')] = {
+        'shape': list(obj.shape),
+        'dtype': obj.dtype.str,
+        'chunks': list(obj.chunks) if obj.chunks else None,
+        'compression': obj.compression,
+        'compression_opts': obj.compression_opts,
+        'length': obj.shape[0] if obj.shape else None}
+  if isinstance(root, h5py.Dataset):
+    describe(root.name, root)
+  else:
+    root.visititems(describe)
+  return metadata
+
+
+def handle_request(sock, msg):
+  """
+  Reads the data asked for by msg from this process's HDF5 handle and sends
+  it back on sock.  If msg carries a 'request_id' it is echoed in a leading
+  JSON frame so that clients with several outstanding requests can match
+  replies to requests.  An optional 'codecs' list, parallel to 'keys', names
+  the transport codec for each array (see curiosity.utils.io.encode_array),
+  and an optional 'shuffle_seed' shuffles batch order per epoch.  A
+  'metadata' request is answered with a single JSON frame describing the
+  datasets under its optional 'group' (see get_metadata).  Everything is
+  read before the first frame is sent, so a failed read leaves the reply
+  unstarted.
+  :param sock: REP socket the request arrived on
+  :param msg: decoded request
+  :return: -
+  """
+  initialize(msg['path'])
+  if 'metadata' in msg:  # If client asks for metadata, describe the datasets without reading them
+    metadata = get_metadata(file, msg.get('group'))
+    if 'request_id' in msg:
+      sock.send_json({'request_id': msg['request_id']}, zmq.SNDMORE)
+    sock.send_json(metadata)
+    return
 
+  keys = msg['keys']
+  if 'size' in msg:  # If client asks for size, return only the size
+    arrays = [np.array(rget(file, keys[0]).shape[0])]
+    codecs = [None]
+  else:
     if 'batch_size' in msg:
       N = rget(file, keys[0]).shape[0]
-      bn = msg['batch_num']
-      batch_size = msg['batch_size']
-      start = (bn * batch_size) % N
-      end = ((bn + 1) * batch_size - 1) % N + 1
-      sl = slice(start, end)
+      ranges = get_batch_ranges(N, msg['batch_num'], msg['batch_size'],
+                                shuffle_seed=msg.get('shuffle_seed'))
     else:
-      sl = slice(None)
-    print("Sending batch %d" % bn)
-    for ind, k in enumerate(keys):
-      data = rget(file, k)[sl]
-      if ind < len(keys) - 1:
-        send_array(sock2, data, flags=zmq.SNDMORE)
+      ranges = None
+    arrays = []
+    for k in keys:
+      if ranges is None:
+        arrays.append(rget(file, k)[:])
+      else:
+        arrays.append(read_ranges(rget(file, k), ranges))
+    codecs = msg.get('codecs') or [None] * len(keys)
+  if 'request_id' in msg:
+    sock.send_json({'request_id': msg['request_id']}, zmq.SNDMORE)
+  for ind, data in enumerate(arrays):
+    if ind < len(arrays) - 1:
+      send_array(sock, data, flags=zmq.SNDMORE, codec=codecs[ind])
+    else:
+      send_array(sock, data, codec=codecs[ind])
+
+
+def send_error(sock, msg, e):
+  """
+  Answers msg with a single JSON frame carrying the error, and its
+  request_id if it had one.
+  """
+  header = {'error': '%s: %s' % (type(e).__name__, e)}
+  if 'request_id' in msg:
+    header['request_id'] = msg['request_id']
+  sock.send_json(header)
+
+
+def worker(backend):
+  """
+  Serves requests handed out by the broker in main.  Each worker runs in its
+  own process with its own HDF5 handle, so reads proceed in parallel.  A
+  request that fails is answered with an error frame (see send_error), so
+  the client is not left waiting.
+  :param backend: address of the broker's DEALER socket
+  :return: -
+  """
+  ctx = zmq.Context()
+  sock = ctx.socket(zmq.REP)
+  sock.connect(backend)
+  while True:
+    msg = sock.recv_json()
+    try:
+      handle_request(sock, msg)
+    except Exception as e:
+      traceback.print_exc()
+      send_error(sock, msg, e)
+
+
+class BatchCache(object):
+  """
+  Byte-bounded LRU cache of serialized batch replies, keyed by request.
+  """
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.entries = OrderedDict()
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    if key in self.entries:
+      frames = self.entries.pop(key)
+      self.entries[key] = frames
+      self.hits += 1
+      return frames
+    self.misses += 1
+    return None
+
+  def put(self, key, frames):
+    size = sum(len(f) for f in frames)
+    if size > self.max_bytes or key in self.entries:
+      return
+    while self.nbytes + size > self.max_bytes:
+      _, old = self.entries.popitem(last=False)
+      self.nbytes -= sum(len(f) for f in old)
+    self.entries[key] = frames
+    self.nbytes += size
+
+  def stats(self):
+    return {'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+            'bytes': self.nbytes,
+            'max_bytes': self.max_bytes}
+
+
+def get_cache_key(msg):
+  """
+  Batch requests are cacheable; the key is the request minus its request_id.
+  """
+  if 'batch_size' not in msg or 'size' in msg:
+    return None
+  msg = dict((k, v) for k, v in msg.items() if k != 'request_id')
+  return json.dumps(msg, sort_keys=True)
+
+
+def split_envelope(frames):
+  delim = frames.index(b'')
+  return frames[:delim + 1], frames[delim + 1:]
+
+
+def reply(frontend, envelope, request_id, frames):
+  if request_id is not None:
+    frames = [json.dumps({'request_id': request_id}).encode('utf-8')] + frames
+  frontend.send_multipart(envelope + frames)
+
+
+def reply_error(frontend, envelope, request_id, error):
+  header = {'error': error}
+  if request_id is not None:
+    header['request_id'] = request_id
+  frontend.send_multipart(envelope + [json.dumps(header).encode('utf-8')])
+
+
+def main(host, port, num_workers=4, cache_bytes=1 << 30):
+  backend_addr = 'ipc:///tmp/hdf5_handler_%d' % port
+  # workers are forked before this process creates its own zmq context
+  for _ in range(num_workers):
+    w = multiprocessing.Process(target=worker, args=(backend_addr,))
+    w.daemon = True
+    w.start()
+
+  ctx = zmq.Context()
+  frontend = ctx.socket(zmq.ROUTER)
+  sockstr = 'tcp://%s:%d' % (host, port)
+  frontend.bind(sockstr)
+  backend = ctx.socket(zmq.DEALER)
+  backend.bind(backend_addr)
+  print('Bound to %s with %d workers' % (sockstr, num_workers))
+
+  cache = BatchCache(cache_bytes)
+  # requests are sent to workers under a sequence number of the broker's own,
+  # since clients may pipeline several requests without ids of their own
+  seq = 0
+  pending = {}   # sequence number -> (envelope, request_id, cache key) of a request sent to a worker
+  waiting = {}   # cache key -> clients waiting for the batch being read
+  poller = zmq.Poller()
+  poller.register(frontend, zmq.POLLIN)
+  poller.register(backend, zmq.POLLIN)
+  while True:
+    socks = dict(poller.poll())
+    if frontend in socks:
+      frames = frontend.recv_multipart()
+      envelope, body = split_envelope(frames)
+      msg = json.loads(body[0].decode('utf-8'))
+      request_id = msg.get('request_id')
+      if 'stats' in msg:  # If client asks for cache stats, answer without a worker
+        reply(frontend, envelope, request_id,
+              [json.dumps(cache.stats()).encode('utf-8')])
+        continue
+      key = get_cache_key(msg)
+      if key is not None:
+        cached = cache.get(key)
+        if cached is not None:
+          reply(frontend, envelope, request_id, cached)
+          continue
+        if key in waiting:
+          # the same batch is already being read for another client
+          waiting[key].append((envelope, request_id))
+          continue
+        waiting[key] = [(envelope, request_id)]
+      pending[seq] = (envelope, request_id, key)
+      msg['request_id'] = seq
+      seq += 1
+      backend.send_multipart([b'', json.dumps(msg).encode('utf-8')])
+    if backend in socks:
+      frames = backend.recv_multipart()
+      _, body = split_envelope(frames)
+      header = json.loads(body[0].decode('utf-8'))
+      envelope, request_id, key = pending.pop(header['request_id'])
+      if key is None:
+        clients = [(envelope, request_id)]
       else:
-        send_array(sock2, data)
+        clients = waiting.pop(key)
+      if 'error' in header:
+        for _envelope, _request_id in clients:
+          reply_error(frontend, _envelope, _request_id, header['error'])
+        continue
+      body = body[1:]
+      if key is not None:
+        cache.put(key, body)
+      for _envelope, _request_id in clients:
+        reply(frontend, _envelope, _request_id, body)
 
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
   parser.add_argument('host', type=str, help="host")
   parser.add_argument('port', type=int, help="port")
+  parser.add_argument('--num_workers', type=int, default=4, help="number of reader processes")
+  parser.add_argument('--cache_bytes', type=int, default=1 << 30, help="size of the batch cache in bytes")
   args = vars(parser.parse_args())
   main(**args)
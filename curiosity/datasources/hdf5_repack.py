@@ -0,0 +1,167 @@
+"""
+Rewrites an HDF5 file into a layout tuned for the batch reads hdf5_handler
+issues, and benchmarks those reads.
+
+Every dataset is chunked along its first axis with batch-aligned chunks, so
+each batch hdf5_handler reads is a whole number of chunks, and may be
+compressed with a fast filter.  With a shuffle seed, the rows of every
+dataset of the same length are reordered by one shared permutation and
+written contiguously, so random-order training data is read in contiguous
+batch slices.  The permutation is stored as _repack/perm<length>: row i of
+the output is row perm[i] of the source.
+"""
+from __future__ import print_function
+
+import time
+import argparse
+
+import numpy as np
+import h5py
+
+from curiosity.datasources.hdf5_handler import get_batch_ranges, read_ranges
+
+
+def get_dataset_paths(f):
+  paths = []
+  def visit(name, obj):
+    if isinstance(obj, h5py.Dataset):
+      paths.append(name)
+  f.visititems(visit)
+  return sorted(paths)
+
+
+def get_chunk_rows(shape, itemsize, batch_size, max_chunk_bytes):
+  """
+  Largest divisor of batch_size whose chunk fits in max_chunk_bytes, so that
+  batch-aligned reads always cover whole chunks.
+  """
+  row_bytes = itemsize * int(np.prod(shape[1:]))
+  for rows in range(min(batch_size, shape[0]), 0, -1):
+    if batch_size % rows == 0 and rows * row_bytes <= max_chunk_bytes:
+      return rows
+  return 1
+
+
+def get_permutation(N, shuffle_seed):
+  return np.random.RandomState(shuffle_seed).permutation(N)
+
+
+def read_rows(dset, rows):
+  """reads the rows with the given indices, in the given order"""
+  # h5py point selections must be strictly increasing
+  uniq, inverse = np.unique(rows, return_inverse=True)
+  return dset[uniq.tolist()][inverse]
+
+
+def repack_dataset(src, dst, path, batch_size, perm=None, compression=None,
+                   compression_opts=None, max_chunk_bytes=1 << 28, block_batches=8):
+  sdset = src[path]
+  if not sdset.shape:
+    # scalars have no rows to chunk or permute, so they are copied as-is
+    src.copy(sdset, dst, name=path)
+    return
+  N = sdset.shape[0]
+  rows = get_chunk_rows(sdset.shape, sdset.dtype.itemsize, batch_size, max_chunk_bytes)
+  ddset = dst.create_dataset(path, shape=sdset.shape, dtype=sdset.dtype,
+                             chunks=(rows,) + sdset.shape[1:],
+                             compression=compression,
+                             compression_opts=compression_opts)
+  for name, val in sdset.attrs.items():
+    ddset.attrs[name] = val
+  block = block_batches * batch_size
+  for start in range(0, N, block):
+    end = min(start + block, N)
+    if perm is None:
+      ddset[start: end] = sdset[start: end]
+    else:
+      ddset[start: end] = read_rows(sdset, perm[start: end])
+    print('%s: %d / %d' % (path, end, N))
+
+
+def repack(src_path, dst_path, batch_size, keys=None, shuffle_seed=None,
+           compression=None, compression_opts=None, max_chunk_bytes=1 << 28,
+           block_batches=8):
+  """
+  Writes the datasets keys (all datasets by default) of src_path to a new
+  file dst_path in the batch-aligned layout described above.
+  :param src_path: path to the source HDF5 file
+  :param dst_path: path to the repacked file
+  :param batch_size: training batch size the chunks are aligned to
+  :param keys: dataset paths to repack, e.g. ['randomperm/images']
+  :param shuffle_seed: seed of the stored row permutation, or None to keep row order
+  :param compression: None, 'lzf' or 'gzip'
+  :param compression_opts: filter options, e.g. the gzip level
+  :param max_chunk_bytes: upper bound on the size of a chunk
+  :param block_batches: number of batches copied at a time
+  :return: -
+  """
+  with h5py.File(src_path, mode='r') as src, h5py.File(dst_path, mode='w') as dst:
+    if keys is None:
+      keys = get_dataset_paths(src)
+    perms = {}
+    for path in keys:
+      N = src[path].shape[0] if src[path].shape else None
+      if shuffle_seed is not None and N is not None and N not in perms:
+        perms[N] = get_permutation(N, shuffle_seed)
+        dst.create_dataset('_repack/perm%d' % N, data=perms[N])
+      repack_dataset(src, dst, path, batch_size, perm=perms.get(N),
+                     compression=compression, compression_opts=compression_opts,
+                     max_chunk_bytes=max_chunk_bytes, block_batches=block_batches)
+    dst.attrs['repack_source'] = src_path
+    dst.attrs['repack_batch_size'] = batch_size
+    if shuffle_seed is not None:
+      dst.attrs['repack_shuffle_seed'] = shuffle_seed
+
+
+def benchmark(path, batch_size, keys=None, num_batches=100, shuffle_seed=None):
+  """
+  Reads num_batches batches of each of keys the way hdf5_handler does and
+  reports the throughput.  Note that batches already in the OS page cache
+  read faster than batches on disk.
+  :return: dict from key to MB/s
+  """
+  results = {}
+  with h5py.File(path, mode='r') as f:
+    if keys is None:
+      keys = [k for k in get_dataset_paths(f)
+              if not k.startswith('_repack/') and f[k].shape]
+    for k in keys:
+      dset = f[k]
+      nbytes = 0
+      t0 = time.time()
+      for batch_num in range(num_batches):
+        ranges = get_batch_ranges(dset.shape[0], batch_num, batch_size,
+                                  shuffle_seed=shuffle_seed)
+        nbytes += read_ranges(dset, ranges).nbytes
+      elapsed = time.time() - t0
+      results[k] = nbytes / float(1 << 20) / elapsed
+      print('%s: %d batches of %d in %.2fs, %.1f MB/s' % (k, num_batches, batch_size,
+                                                         elapsed, results[k]))
+  return results
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  subparsers = parser.add_subparsers(dest='command')
+  repack_parser = subparsers.add_parser('repack', help="rewrite a file in the batch-aligned layout")
+  repack_parser.add_argument('src_path', type=str, help="source HDF5 file")
+  repack_parser.add_argument('dst_path', type=str, help="repacked HDF5 file")
+  repack_parser.add_argument('batch_size', type=int, help="batch size to align chunks to")
+  repack_parser.add_argument('--keys', type=str, nargs='+', default=None, help="datasets to repack (default all)")
+  repack_parser.add_argument('--shuffle_seed', type=int, default=None, help="seed of the stored row permutation")
+  repack_parser.add_argument('--compression', type=str, default=None, choices=['lzf', 'gzip'])
+  repack_parser.add_argument('--compression_opts', type=int, default=None, help="gzip level")
+  repack_parser.add_argument('--max_chunk_bytes', type=int, default=1 << 28)
+  repack_parser.add_argument('--block_batches', type=int, default=8, help="batches copied at a time")
+  benchmark_parser = subparsers.add_parser('benchmark', help="measure batch read throughput")
+  benchmark_parser.add_argument('path', type=str, help="HDF5 file")
+  benchmark_parser.add_argument('batch_size', type=int, help="batch size")
+  benchmark_parser.add_argument('--keys', type=str, nargs='+', default=None, help="datasets to read (default all)")
+  benchmark_parser.add_argument('--num_batches', type=int, default=100)
+  benchmark_parser.add_argument('--shuffle_seed', type=int, default=None, help="read batches in shuffled order")
+  args = vars(parser.parse_args())
+  command = args.pop('command')
+  if command == 'repack':
+    repack(**args)
+  else:
+    benchmark(**args)
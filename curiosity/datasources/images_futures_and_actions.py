@@ -5,11 +5,12 @@ import numpy as np
 import os
 import zmq
 
-from curiosity.utils.image import norml
-from curiosity.utils.io import recv_array
+from curiosity.utils.image import BufferRing, norml_into
+from curiosity.utils.io import negotiate_codecs, recv_array
 
 ctx = zmq.Context()
 sock = None
+buffers = None
 
 def initialize(host, port):
   global ctx, sock
@@ -19,20 +20,25 @@ def initialize(host, port):
   print("...connected")
 
 
-def getNextBatch(batch_num, batch_size, host, port, datapath, keyname):
-  global sock
+def getNextBatch(batch_num, batch_size, host, port, datapath, keyname, codecs=None,
+                 shuffle_seed=None, num_buffers=0, dtype='float32'):
+  global sock, buffers
   if sock is None:
     initialize(host, port)
+  if buffers is None:
+    buffers = BufferRing(num_buffers)
 
   sock.send_json({'batch_num': batch_num,
                   'batch_size': batch_size,
                   'path': datapath,
+                  'codecs': negotiate_codecs(codecs),
+                  'shuffle_seed': shuffle_seed,
                   'keys': [(keyname, 'images0'), 
                            (keyname, 'images1'),
                            (keyname, 'actions'),
                            (keyname, 'timediff')]})
-  images = norml(recv_array(sock))
-  futures = norml(recv_array(sock))
+  images = norml_into(buffers, 'images', recv_array(sock), dtype)
+  futures = norml_into(buffers, 'futures', recv_array(sock), dtype)
   actions = recv_array(sock)
   timediff = recv_array(sock)
 
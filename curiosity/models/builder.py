@@ -0,0 +1,593 @@
+"""
+architecture engine shared by the model modules
+
+A model's cfg is resolved once, with slippage, into a ModelSpec of typed
+layers, together with the cfg0 that is recorded in the database.  The graph
+is then emitted from the spec.  Resolution draws from rng in the same order
+as the per-module getters it replaces, so a given seed and cfg give the same
+architecture and the same variables as before.
+
+The build_* functions take the dtype of the activations.  With float16,
+variables are still created as float32 master weights and cast where they
+are used, and losses are summed in float32.
+
+Graphs cached by curiosity.utils.graphcache are keyed on the source of this
+module as well as on that of the model module, so a change here is never
+served a graph built by the old code.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy as np
+import tensorflow as tf
+
+# size is the spatial size of the layer's output; pool is a PoolLayer or None
+ConvLayer = namedtuple('ConvLayer', ['filter_size', 'num_filters', 'stride', 'pool', 'size'])
+PoolLayer = namedtuple('PoolLayer', ['filter_size', 'stride', 'type'])
+HiddenLayer = namedtuple('HiddenLayer', ['num_features'])
+# the first DecodeLayer is the unflattened hidden layer, with only size and num_filters
+DecodeLayer = namedtuple('DecodeLayer', ['size', 'bypass', 'filter_size', 'num_filters'])
+# the first CoupledDecodeLayer has no filter_size
+CoupledDecodeLayer = namedtuple('CoupledDecodeLayer', ['filter_size', 'num_filters', 'filter_size2'])
+ModelSpec = namedtuple('ModelSpec', ['filter_seed', 'encode', 'hidden', 'decode'])
+
+
+def getEncodeDepth(rng, cfg, slippage=0):
+  val = None
+  if 'encode_depth' in cfg:
+    val = cfg['encode_depth']
+  elif 'encode' in cfg:
+    val = max(cfg['encode'].keys())
+  if val is not None and rng.uniform() > slippage:
+    return val
+  d = rng.choice([1, 2, 3, 4, 5])
+  return d
+
+def getEncodeConvFilterSize(i, encode_depth, rng, cfg, prev=None, slippage=0):
+  val = None
+  if 'encode' in cfg and (i in cfg['encode']):
+    if 'conv' in cfg['encode'][i]:
+      if 'filter_size' in cfg['encode'][i]['conv']:
+        val = cfg['encode'][i]['conv']['filter_size']
+  if val is not None and rng.uniform() > slippage:
+    return val
+  L = [1, 3, 5, 7, 9, 11, 13, 15, 23]
+  if prev is not None:
+    L = [_l for _l in L if _l <= prev]
+  return rng.choice(L)
+
+def getEncodeConvNumFilters(i, encode_depth, rng, cfg, slippage=0):
+  val = None
+  if 'encode' in cfg and (i in cfg['encode']):
+    if 'conv' in cfg['encode'][i]:
+      if 'num_filters' in cfg['encode'][i]['conv']:
+        val = cfg['encode'][i]['conv']['num_filters']
+  if val is not None and rng.uniform() > slippage:
+    return val
+  L = [3, 48, 96, 128, 256, 128]
+  return L[i]
+
+def getEncodeConvStride(i, encode_depth, rng, cfg, slippage=0):
+  val = None
+  if 'encode' in cfg and (i in cfg['encode']):
+    if 'conv' in cfg['encode'][i]:
+      if 'stride' in cfg['encode'][i]['conv']:
+        val = cfg['encode'][i]['conv']['stride']
+  if val is not None and rng.uniform() > slippage:
+    return val
+  if encode_depth > 1:
+    return 2 if i == 1 else 1
+  else:
+    return 3 if i == 1 else 1
+
+def getEncodeDoPool(i, encode_depth, rng, cfg, slippage=0):
+  val = None
+  if 'encode' in cfg and (i in cfg['encode']):
+    if 'do_pool' in cfg['encode'][i]:
+      val = cfg['encode'][i]['do_pool']
+    elif 'pool' in cfg['encode'][i]:
+      val = True
+  if val is not None and rng.uniform() > slippage:
+    return val
+  if i < 3 or i == encode_depth:
+    return rng.uniform() < .75
+  else:
+    return rng.uniform() < .25
+
+def getEncodePoolFilterSize(i, encode_depth, rng, cfg, slippage=0):
+  val = None
+  if 'encode' in cfg and (i in cfg['encode']):
+    if 'pool' in cfg['encode'][i]:
+      if 'filter_size' in cfg['encode'][i]['pool']:
+        val = cfg['encode'][i]['pool']['filter_size']
+  if val is not None and rng.uniform() > slippage:
+    return val
+  return rng.choice([2, 3, 4, 5])
+
+def getEncodePoolStride(i, encode_depth, rng, cfg, slippage=0):
+  val = None
+  if 'encode' in cfg and (i in cfg['encode']):
+    if 'pool' in cfg['encode'][i]:
+      if 'stride' in cfg['encode'][i]['pool']:
+        val = cfg['encode'][i]['pool']['stride']
+  if val is not None and rng.uniform() > slippage:
+    return val
+  return 2
+
+def getEncodePoolType(i, encode_depth, rng, cfg, slippage=0):
+  val = None
+  if 'encode' in cfg and (i in cfg['encode']):
+    if 'pool' in cfg['encode'][i]:
+      if 'type' in cfg['encode'][i]['pool']:
+        val = cfg['encode'][i]['pool']['type']
+  if val is not None and rng.uniform() > slippage:
+    return val
+  return rng.choice(['max', 'avg'])
+
+def getHiddenDepth(rng, cfg, slippage=0):
+  val = None
+  if (not rng.uniform() < slippage) and 'hidden_depth' in cfg:
+    val = cfg['hidden_depth']
+  elif 'hidden' in cfg:
+    val = max(cfg['hidden'].keys())
+  if val is not None and rng.uniform() > slippage:
+    return val
+  d = rng.choice([1, 2, 3])
+  return d
+
+def getHiddenNumFeatures(i, hidden_depth, rng, cfg, slippage=0, default=1024, final=None):
+  """final, if given, fixes the size of the last hidden layer"""
+  if final is not None and i == hidden_depth:
+    return final
+  val = None
+  if 'hidden' in cfg and (i in cfg['hidden']):
+    if 'num_features' in cfg['hidden'][i]:
+      val = cfg['hidden'][i]['num_features']
+  if val is not None and rng.uniform() > slippage:
+    return val
+  return default
+
+def getDecodeDepth(rng, cfg, slippage=0):
+  val = None
+  if 'decode_depth' in cfg:
+    val = cfg['decode_depth']
+  elif 'decode' in cfg:
+    val = max(cfg['decode'].keys())
+  if val is not None and rng.uniform() > slippage:
+    return val
+  d = rng.choice([1, 2, 3])
+  return d
+
+def getDecodeNumFilters(i, decode_depth, rng, cfg, slippage=0, final=None):
+  """final, if given, fixes the number of filters of the last decode layer"""
+  if final is not None and i >= decode_depth:
+    return final
+  val = None
+  if 'decode' in cfg and (i in cfg['decode']):
+    if 'num_filters' in cfg['decode'][i]:
+      val = cfg['decode'][i]['num_filters']
+  if val is not None and rng.uniform() > slippage:
+    return val
+  return 32
+
+def getDecodeFilterSize(i, decode_depth, rng, cfg, slippage=0):
+  val = None
+  if 'decode' in cfg and (i in cfg['decode']):
+     if 'filter_size' in cfg['decode'][i]:
+       val = cfg['decode'][i]['filter_size']
+  if val is not None and rng.uniform() > slippage:
+    return val
+  return rng.choice([1, 3, 5, 7, 9, 11])
+
+def getDecodeFilterSize2(i, decode_depth, rng, cfg, slippage=0):
+  val = None
+  if 'decode' in cfg and (i in cfg['decode']):
+     if 'filter_size2' in cfg['decode'][i]:
+       val = cfg['decode'][i]['filter_size2']
+  if val is not None and rng.uniform() > slippage:
+    return val
+  return rng.choice([1, 3, 5, 7, 9, 11])
+
+def getDecodeSize(i, decode_depth, init, final, rng, cfg, slippage=0):
+  val = None
+  if 'decode' in cfg and (i in cfg['decode']):
+    if 'size' in cfg['decode'][i]:
+      val = cfg['decode'][i]['size']
+  if val is not None and rng.uniform() > slippage:
+    return val
+  s = np.log2(init)
+  e = np.log2(final)
+  increment = (e - s) / decode_depth
+  l = np.around(np.power(2, np.arange(s, e, increment)))
+  if len(l) < decode_depth + 1:
+    l = np.concatenate([l, [final]])
+  l = l.astype(np.int)
+  return l[i]
+
+def getDecodeBypass(i, encode_sizes, decode_size, decode_depth, rng, cfg, slippage=0):
+  val = None
+  if 'decode' in cfg and (i in cfg['decode']):
+    if 'bypass' in cfg['decode'][i]:
+      val = cfg['decode'][i]['bypass']
+  #prevent error that can occur here if encode is not large enough due to slippage modification?
+  if val is not None and rng.uniform() > slippage:
+    return val
+  switch = rng.uniform()
+  if switch < 0.5:
+    sdiffs = [s - decode_size for s in encode_sizes]
+    return np.abs(sdiffs).argmin()
+
+def getFilterSeed(rng, cfg):
+  if 'filter_seed' in cfg:
+    return cfg['filter_seed']
+  else:
+    return rng.randint(10000)
+
+
+def get_output_size(size, stride):
+  """spatial size of the output of a 'SAME' padded conv or pool"""
+  return -(-size // stride)
+
+
+def resolve_encode(rng, cfg, cfg0, image_size, slippage=0):
+  encode_depth = getEncodeDepth(rng, cfg, slippage=slippage)
+  cfg0['encode_depth'] = encode_depth
+  print('Encode depth: %d' % encode_depth)
+  layers = []
+  size = image_size
+  cfs0 = None
+  cfg0['encode'] = {}
+  for i in range(1, encode_depth + 1):
+    cfg0['encode'][i] = {}
+    cfs = getEncodeConvFilterSize(i, encode_depth, rng, cfg, prev=cfs0, slippage=slippage)
+    cfg0['encode'][i]['conv'] = {'filter_size': cfs}
+    cfs0 = cfs
+    nf = getEncodeConvNumFilters(i, encode_depth, rng, cfg, slippage=slippage)
+    cfg0['encode'][i]['conv']['num_filters'] = nf
+    cs = getEncodeConvStride(i, encode_depth, rng, cfg, slippage=slippage)
+    cfg0['encode'][i]['conv']['stride'] = cs
+    size = get_output_size(size, cs)
+    pool = None
+    do_pool = getEncodeDoPool(i, encode_depth, rng, cfg, slippage=slippage)
+    if do_pool:
+      pfs = getEncodePoolFilterSize(i, encode_depth, rng, cfg, slippage=slippage)
+      cfg0['encode'][i]['pool'] = {'filter_size': pfs}
+      ps = getEncodePoolStride(i, encode_depth, rng, cfg, slippage=slippage)
+      cfg0['encode'][i]['pool']['stride'] = ps
+      pool_type = getEncodePoolType(i, encode_depth, rng, cfg, slippage=slippage)
+      cfg0['encode'][i]['pool']['type'] = pool_type
+      pool = PoolLayer(pfs, ps, pool_type)
+      size = get_output_size(size, ps)
+    layers.append(ConvLayer(cfs, nf, cs, pool, size))
+  return layers
+
+
+def resolve_hidden(rng, cfg, cfg0, slippage=0, default=1024, final=None):
+  hidden_depth = getHiddenDepth(rng, cfg, slippage=slippage)
+  cfg0['hidden_depth'] = hidden_depth
+  layers = []
+  cfg0['hidden'] = {}
+  for i in range(1, hidden_depth + 1):
+    nf = getHiddenNumFeatures(i, hidden_depth, rng, cfg, slippage=slippage,
+                              default=default, final=final)
+    cfg0['hidden'][i] = {'num_features': nf}
+    layers.append(HiddenLayer(nf))
+  return layers
+
+
+def resolve_decode(rng, cfg, cfg0, encode_sizes, num_channels, slippage=0):
+  """
+  resolves the decoder of the asymmetric models, which upsamples from the
+  top of the encoder to the input size, with optional bypasses from the
+  encoder layers
+  :param encode_sizes: spatial sizes of the input and of every encode layer
+  """
+  image_size = encode_sizes[0]
+  decode_depth = getDecodeDepth(rng, cfg, slippage=slippage)
+  cfg0['decode_depth'] = decode_depth
+  print('Decode depth: %d' % decode_depth)
+  nf = getDecodeNumFilters(0, decode_depth, rng, cfg, slippage=slippage, final=num_channels)
+  cfg0['decode'] = {0: {'num_filters': nf}}
+  ds = getDecodeSize(0, decode_depth, encode_sizes[-1], image_size, rng, cfg, slippage=slippage)
+  cfg0['decode'][0]['size'] = ds
+  layers = [DecodeLayer(ds, None, None, nf)]
+  for i in range(1, decode_depth + 1):
+    ds = getDecodeSize(i, decode_depth, encode_sizes[-1], image_size, rng, cfg, slippage=slippage)
+    cfg0['decode'][i] = {'size': ds}
+    if i == decode_depth:
+       assert ds == image_size, (ds, image_size)
+    add_bypass = getDecodeBypass(i, encode_sizes, ds, decode_depth, rng, cfg, slippage=slippage)
+    if add_bypass is not None:
+      cfg0['decode'][i]['bypass'] = add_bypass
+    cfs = getDecodeFilterSize(i, decode_depth, rng, cfg, slippage=slippage)
+    cfg0['decode'][i]['filter_size'] = cfs
+    nf = getDecodeNumFilters(i, decode_depth, rng, cfg, slippage=slippage, final=num_channels)
+    cfg0['decode'][i]['num_filters'] = nf
+    if i == decode_depth:
+      assert nf == num_channels, (nf, num_channels)
+    layers.append(DecodeLayer(ds, add_bypass, cfs, nf))
+  return layers
+
+
+def resolve_coupled_decode(rng, cfg, cfg0, encode_depth, slippage=0):
+  """
+  resolves the decoder of the symmetric coupled models, which has one layer
+  per encode layer
+  """
+  nf1 = getDecodeNumFilters(0, encode_depth, rng, cfg, slippage=slippage)
+  cfg0['decode'] = {0: {'num_filters': nf1}}
+  cfs2 = getDecodeFilterSize2(0, encode_depth, rng, cfg, slippage=slippage)
+  layers = [CoupledDecodeLayer(None, nf1, cfs2)]
+  for i in range(1, encode_depth + 1):
+    cfs = getDecodeFilterSize(i, encode_depth, rng, cfg, slippage=slippage)
+    cfg0['decode'][i] = {'filter_size': cfs}
+    nf1 = getDecodeNumFilters(i, encode_depth, rng, cfg, slippage=slippage)
+    cfg0['decode'][i]['num_filters'] = nf1
+    cfs2 = getDecodeFilterSize2(i, encode_depth, rng, cfg, slippage=slippage)
+    cfg0['decode'][i]['filter_size2'] = cfs2
+    layers.append(CoupledDecodeLayer(cfs, nf1, cfs2))
+  return layers
+
+
+def resolve(rng, cfg, image_size, num_channels, slippage=0, decoder='bypass',
+            hidden_default=1024, hidden_final=None):
+  """
+  Resolves cfg into a ModelSpec.
+  :param image_size: spatial size of the input images
+  :param num_channels: channels of the input images, and of the bypass decoder output
+  :param decoder: 'bypass' (see resolve_decode), 'coupled' (see
+  resolve_coupled_decode) or None
+  :param hidden_default: default number of features of a hidden layer
+  :param hidden_final: if given, the number of features of the last hidden layer
+  :return: the spec and the resolved cfg0
+  """
+  cfg0 = {}
+  fseed = getFilterSeed(rng, cfg)
+  encode = resolve_encode(rng, cfg, cfg0, image_size, slippage=slippage)
+  hidden = resolve_hidden(rng, cfg, cfg0, slippage=slippage,
+                          default=hidden_default, final=hidden_final)
+  if decoder == 'bypass':
+    encode_sizes = [image_size] + [l.size for l in encode]
+    decode = resolve_decode(rng, cfg, cfg0, encode_sizes, num_channels, slippage=slippage)
+  elif decoder == 'coupled':
+    decode = resolve_coupled_decode(rng, cfg, cfg0, len(encode), slippage=slippage)
+  else:
+    decode = None
+  return ModelSpec(fseed, encode, hidden, decode), cfg0
+
+
+def cast(x, dtype):
+  if x.dtype.base_dtype == dtype:
+    return x
+  return tf.cast(x, dtype)
+
+
+_tower_variables = None
+
+@contextmanager
+def tower_variables(variables):
+  """
+  Within this context, variable() appends the variables it creates to the
+  list variables if it is empty, and otherwise hands out its variables again
+  in creation order.  A model built a second time from the same rng state
+  and cfg thus shares the variables of the first build, as a data-parallel
+  tower does.
+  """
+  global _tower_variables
+  prev = _tower_variables
+  _tower_variables = {'variables': variables,
+                      'reuse': len(variables) > 0,
+                      'index': 0}
+  try:
+    yield
+  finally:
+    _tower_variables = prev
+
+
+def variable(initial_value, dtype=tf.float32):
+  """a float32 master variable, or the next shared one, cast to dtype"""
+  towers = _tower_variables
+  if towers is not None and towers['reuse']:
+    v = towers['variables'][towers['index']]
+    towers['index'] += 1
+  else:
+    v = tf.Variable(initial_value)
+    if towers is not None:
+      towers['variables'].append(v)
+  return cast(v, dtype)
+
+
+def resize(x, size):
+  """resize_images, which returns float32, in the dtype of x"""
+  return cast(tf.image.resize_images(x, size, size), x.dtype.base_dtype)
+
+
+def clip(low, high):
+  return lambda x: tf.minimum(tf.maximum(x, low), high)
+
+
+def build_encode(data, layers, num_channels, fseed, dtype=tf.float32):
+  """
+  emits the encoder on data
+  :return: list of data and the output of every encode layer
+  """
+  nf0 = num_channels
+  encode_nodes = [data]
+  for i, layer in enumerate(layers, 1):
+    cfs, nf, cs = layer.filter_size, layer.num_filters, layer.stride
+    W = variable(tf.truncated_normal([cfs, cfs, nf0, nf],
+                                     stddev=0.01,
+                                     seed=fseed), dtype)
+    new_encode_node = tf.nn.conv2d(encode_nodes[i-1], W,
+                               strides = [1, cs, cs, 1],
+                               padding='SAME')
+    new_encode_node = tf.nn.relu(new_encode_node)
+    b = variable(tf.zeros([nf]), dtype)
+    new_encode_node = tf.nn.bias_add(new_encode_node, b)
+    print('Encode conv %d with size %d stride %d num channels %d numfilters %d for shape' % (i, cfs, cs, nf0, nf), new_encode_node.get_shape().as_list())
+    if layer.pool is not None:
+      pfs, ps, pool_type = layer.pool
+      if pool_type == 'max':
+        pfunc = tf.nn.max_pool
+      elif pool_type == 'avg':
+        pfunc = tf.nn.avg_pool
+      new_encode_node = pfunc(new_encode_node,
+                          ksize = [1, pfs, pfs, 1],
+                          strides = [1, ps, ps, 1],
+                          padding='SAME')
+      print('Encode %s pool %d with size %d stride %d for shape' % (pool_type, i, pfs, ps),
+                    new_encode_node.get_shape().as_list())
+    nf0 = nf
+    encode_nodes.append(new_encode_node)
+  return encode_nodes
+
+
+def build_paired_encode(current_node, future_node, layers, num_channels, fseed,
+                        dtype=tf.float32):
+  """
+  emits the encoder on current and future, which share it and so are
+  encoded as one batch
+  :return: lists of the current and future encode nodes
+  """
+  encode_nodes = build_encode(tf.concat(0, [current_node, future_node]),
+                              layers, num_channels, fseed, dtype=dtype)
+  encode_nodes_current, encode_nodes_future = zip(*[tf.split(0, 2, node)
+                                                    for node in encode_nodes])
+  return list(encode_nodes_current), list(encode_nodes_future)
+
+
+def flatten(node):
+  shape = node.get_shape().as_list()
+  flat = tf.reshape(node, [shape[0], np.prod(shape[1:])])
+  print('Flatten to shape %s' % flat.get_shape().as_list())
+  return flat
+
+
+def build_hidden(hidden, layers, fseed, relu_last=True, dtype=tf.float32):
+  nf0 = hidden.get_shape().as_list()[1]
+  for i, layer in enumerate(layers, 1):
+    nf = layer.num_features
+    W = variable(tf.truncated_normal([nf0, nf],
+                                     stddev = 0.01,
+                                     seed=fseed), dtype)
+    b = variable(tf.constant(0.01, shape=[nf]), dtype)
+    hidden = tf.matmul(hidden, W) + b
+    if relu_last or i < len(layers):
+      hidden = tf.nn.relu(hidden)
+    print('hidden layer %d %s' % (i, str(hidden.get_shape().as_list())))
+    nf0 = nf
+  return hidden
+
+
+def unflatten(hidden, ds, nf, fseed, dtype=tf.float32):
+  """reshapes hidden to ds x ds x nf, through a linear layer if its size differs"""
+  batch_size, nf0 = hidden.get_shape().as_list()
+  if ds * ds * nf != nf0:
+    W = variable(tf.truncated_normal([nf0, ds * ds * nf],
+                                     stddev = 0.01,
+                                     seed=fseed), dtype)
+    b = variable(tf.constant(0.01, shape=[ds * ds * nf]), dtype)
+    hidden = tf.matmul(hidden, W) + b
+    print("Linear from %d to %d for input size %d" % (nf0, ds * ds * nf, ds))
+  decode = tf.reshape(hidden, [batch_size, ds, ds, nf])
+  print("Unflattening to", decode.get_shape().as_list())
+  return decode
+
+
+def conv(node, cfs, nf0, nf, fseed, dtype=tf.float32):
+  W = variable(tf.truncated_normal([cfs, cfs, nf0, nf],
+                                   stddev=0.1,
+                                   seed=fseed), dtype)
+  b = variable(tf.zeros([nf]), dtype)
+  node = tf.nn.conv2d(node,
+                      W,
+                      strides=[1, 1, 1, 1],
+                      padding='SAME')
+  return tf.nn.bias_add(node, b)
+
+
+def build_decode(hidden, layers, encode_nodes, fseed, final_activation=None,
+                 dtype=tf.float32):
+  """
+  emits the decoder resolved by resolve_decode
+  :param final_activation: applied to the output, which has no relu
+  """
+  nf, ds = layers[0].num_filters, layers[0].size
+  decode = unflatten(hidden, ds, nf, fseed, dtype=dtype)
+  for i, layer in enumerate(layers[1:], 1):
+    nf0 = nf
+    ds = layer.size
+    decode = resize(decode, ds)
+    print('Decode resize %d to shape' % i, decode.get_shape().as_list())
+    if layer.bypass is not None:
+      bypass_layer = encode_nodes[layer.bypass]
+      bypass_shape = bypass_layer.get_shape().as_list()
+      if bypass_shape[1] != ds:
+        bypass_layer = resize(bypass_layer, ds)
+      decode = tf.concat(3, [decode, bypass_layer])
+      print('Decode bypass from %d at %d for shape' % (layer.bypass, i), decode.get_shape().as_list())
+      nf0 = nf0 + bypass_shape[-1]
+    cfs, nf = layer.filter_size, layer.num_filters
+    decode = conv(decode, cfs, nf0, nf, fseed, dtype=dtype)
+    print('Decode conv %d with size %d num channels %d numfilters %d for shape' % (i, cfs, nf0, nf), decode.get_shape().as_list())
+    if i < len(layers) - 1:
+      decode = tf.nn.relu(decode)
+    elif final_activation is not None:
+      decode = final_activation(decode)
+  return decode
+
+
+def build_coupled_decode(hidden, layers, encode_nodes_current, encode_nodes_future,
+                         fseed, activation=tf.nn.relu, final_activation=None,
+                         residual=False, dtype=tf.float32):
+  """
+  emits the decoder resolved by resolve_coupled_decode.  At every level the
+  top-down decode is combined with the current encoding into a prediction of
+  the future encoding (of its difference to the current one if residual),
+  and the normalized l2 losses of all levels are summed.
+  :param activation: applied to the predictions below the top
+  :param final_activation: applied to the prediction of the input level
+  :return: the loss and the prediction of the input level
+  """
+  encode_depth = len(layers) - 1
+  batch_size = hidden.get_shape().as_list()[0]
+
+  def level_loss(pred, level, nf, ds):
+    norm = (ds**2) * batch_size * nf
+    diff = cast(pred, tf.float32) - cast(encode_nodes_future[level], tf.float32)
+    if residual:
+      diff = diff + cast(encode_nodes_current[level], tf.float32)
+    return tf.nn.l2_loss(diff) / norm
+
+  ds = encode_nodes_future[encode_depth].get_shape().as_list()[1]
+  nf1 = layers[0].num_filters
+  decode = unflatten(hidden, ds, nf1, fseed, dtype=dtype)
+
+  pred = tf.concat(3, [decode, encode_nodes_current[encode_depth]])
+  nf = encode_nodes_future[encode_depth].get_shape().as_list()[-1]
+  pred = activation(conv(pred, layers[0].filter_size2, nf + nf1, nf, fseed, dtype=dtype))
+  loss = level_loss(pred, encode_depth, nf, ds)
+
+  for i, layer in enumerate(layers[1:], 1):
+    nf0 = nf1
+    ds = encode_nodes_future[encode_depth - i].get_shape().as_list()[1]
+    decode = resize(decode, ds)
+    print('Decode resize %d to shape' % i, decode.get_shape().as_list())
+    nf1 = layer.num_filters
+    decode = tf.nn.relu(conv(decode, layer.filter_size, nf0, nf1, fseed, dtype=dtype))
+
+    pred = tf.concat(3, [decode, encode_nodes_current[encode_depth - i]])
+    nf = encode_nodes_future[encode_depth - i].get_shape().as_list()[-1]
+    pred = conv(pred, layer.filter_size2, nf + nf1, nf, fseed, dtype=dtype)
+    if i == encode_depth:
+      if final_activation is not None:
+        pred = final_activation(pred)
+    else:
+      pred = activation(pred)
+    loss = loss + level_loss(pred, encode_depth - i, nf, ds)
+
+  return loss, pred
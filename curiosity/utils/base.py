@@ -6,27 +6,173 @@ import argparse
 import time
 import os
 import json
+import sys
+import traceback
 from importlib import import_module
 
 import pymongo as pm
 import numpy as np
 
+import six
 from six.moves import xrange
 import tensorflow as tf
 
+from curiosity.models import builder
 from curiosity.utils import error
-from curiosity.utils.loadsave import (get_checkpoint_path,
+from curiosity.utils.metrics import BufferedInserter, compare_losses
+from curiosity.utils.prefetch import BatchPrefetcher
+from curiosity.utils.graphcache import get_graph_key, export_graph, import_graph
+from curiosity.utils.timing import PhaseTimer, save_run_metadata
+from curiosity.utils.loadsave import (AsyncWriter,
+                                      isint,
+                                      get_latest_checkpoint_step,
+                                      load_checkpoint,
+                                      save_checkpoint,
+                                      save_outputs,
+                                      save_packed_checkpoint,
                                       preprocess_config,
                                       postprocess_config)
 
 
-def isint(x):
-  try:
-    int(x)
-  except:
-    return False
-  else:
-    return True
+def assign_variables(sess, Vars, vals):
+  """assign values to all of Vars with a single sess.run"""
+  placeholders = [tf.placeholder(v.dtype.base_dtype, shape=v.get_shape())
+                  for v in Vars]
+  assign_op = tf.group(*[v.assign(p) for v, p in zip(Vars, placeholders)])
+  sess.run(assign_op, feed_dict=dict(zip(placeholders, vals)))
+
+
+def get_accumulating_train_ops(optimizer, grads_and_vars, accumulate_steps, global_step):
+  """
+  returns an op that adds the gradients of a sub-batch to accumulators, and
+  an op that applies their mean and resets them.  The accumulators are zero
+  between steps, so they are local variables, left out of checkpoints.
+  """
+  accumulators = [tf.Variable(tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype),
+                              trainable=False,
+                              collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                  for g, v in grads_and_vars]
+  accumulate = tf.group(*[a.assign_add(g)
+                          for a, (g, v) in zip(accumulators, grads_and_vars)])
+  apply_op = optimizer.apply_gradients([(a / accumulate_steps, v)
+                                        for a, (g, v) in zip(accumulators, grads_and_vars)],
+                                       global_step=global_step)
+  with tf.control_dependencies([apply_op]):
+    reset = tf.group(*[a.assign(tf.zeros_like(a)) for a in accumulators])
+  return accumulate, reset
+
+
+def build_towers(model_func, rng, tower_batch_size, cfg0, slippage, slippage_error,
+                 model_func_kwargs, devices):
+  """
+  Builds one tower of the model per entry of devices (None for the default
+  device).  Every tower is built from the same rng state, so all resolve to
+  the same architecture, and they share the variables of the first tower
+  through builder.tower_variables.  The first tower is built outside any
+  name scope, so its variable names, and thus checkpoints, are those of a
+  single-tower run.
+  :return: the output nodes of the towers combined (scalars averaged, others
+  concatenated along the batch), the input node dicts of the towers, and cfg
+  """
+  rng_state = rng.get_state()
+  variables = []
+  outnodedicts = []
+  innodedicts = []
+  for k, device in enumerate(devices):
+    rng.set_state(rng_state)
+    with tf.device(device), builder.tower_variables(variables):
+      if k == 0:
+        outnodedict, innodedict, cfg = model_func(rng, tower_batch_size, cfg0, slippage,
+                                                  slippage_error, **model_func_kwargs)
+        num_vars = len(tf.all_variables())
+      else:
+        with tf.name_scope('tower_%d' % k):
+          outnodedict, innodedict, cfg = model_func(rng, tower_batch_size, cfg0, slippage,
+                                                    slippage_error, **model_func_kwargs)
+    outnodedicts.append(outnodedict)
+    innodedicts.append(innodedict)
+  assert len(tf.all_variables()) == num_vars, \
+      "model_func creates variables outside the model builder, which towers cannot share"
+  if len(devices) == 1:
+    return outnodedicts[0], innodedicts, cfg
+  combined = {}
+  for name in outnodedicts[0]:
+    nodes = [o[name] for o in outnodedicts]
+    if nodes[0].get_shape().ndims == 0:
+      combined[name] = tf.add_n(nodes) / len(nodes)
+    else:
+      combined[name] = tf.concat(0, nodes)
+  return combined, innodedicts, cfg
+
+
+def join_tower_nodes(innodedicts):
+  """one dict of the input nodes of all towers, for the graph cache"""
+  nodes = dict(innodedicts[0])
+  for k, innodedict in enumerate(innodedicts[1:], 1):
+    for name, node in innodedict.items():
+      nodes['tower_%d/%s' % (k, name)] = node
+  return nodes
+
+
+def split_tower_nodes(nodes, num_towers):
+  innodedicts = [{} for _ in range(num_towers)]
+  for name, node in nodes.items():
+    if name.startswith('tower_'):
+      k, name = name[len('tower_'):].split('/', 1)
+      innodedicts[int(k)][name] = node
+    else:
+      innodedicts[0][name] = node
+  return innodedicts
+
+
+def get_feed_dict(innodedicts, batch_data):
+  """feeds every tower its shard of batch_data"""
+  num_towers = len(innodedicts)
+  feed_dict = {}
+  for k, innodedict in enumerate(innodedicts):
+    for name, node in innodedict.items():
+      val = batch_data[name]
+      if num_towers > 1:
+        shard_size = len(val) // num_towers
+        val = val[k * shard_size: (k + 1) * shard_size]
+      feed_dict[node] = val
+  return feed_dict
+
+
+def close_all(resources):
+  """
+  Closes each of the resources (None entries are skipped), even when closing an
+  earlier one fails; the first failure is re-raised once all are closed.
+  """
+  exc_info = None
+  for resource in resources:
+    if resource is None:
+      continue
+    try:
+      resource.close()
+    except Exception:
+      if exc_info is None:
+        exc_info = sys.exc_info()
+  if exc_info is not None:
+    six.reraise(*exc_info)
+
+
+def get_output_snapshot(outval_dict, nodes=None, downsample=None, dtype=None):
+  """
+  selects the named outputs (all if nodes is None), subsamples the spatial
+  axes of image-shaped ones by downsample, and casts floats to dtype
+  """
+  snapshot = {}
+  for name, val in outval_dict.items():
+    if nodes is not None and name not in nodes:
+      continue
+    val = np.asarray(val)
+    if downsample and val.ndim == 4:
+      val = val[:, ::downsample, ::downsample, :]
+    if dtype is not None and val.dtype.kind == 'f':
+      val = val.astype(dtype)
+    snapshot[name] = val
+  return snapshot
 
 
 def run(dbname,
@@ -51,7 +197,25 @@ def run(dbname,
         test_frequency=20,
         save_multiple=1,
         erase_earlier=None,
-        additional_metrics=None):
+        additional_metrics=None,
+        metrics_buffer_size=100,
+        metrics_flush_interval=10.,
+        output_save_frequency=1,
+        output_save_nodes=None,
+        output_save_downsample=None,
+        output_save_dtype=None,
+        prefetch=0,
+        checkpoint_format='npy',
+        timing_window=100,
+        trace_frequency=0,
+        graph_cache_dir=None,
+        mixed_precision=False,
+        loss_scale=128.,
+        reference_experiment_id=None,
+        reference_rtol=0.05,
+        reference_max_step=None,
+        accumulate_steps=1,
+        tower_devices=None):
   conn = pm.MongoClient('localhost', 29101)
   db = conn[dbname]
   coll = db[colname]
@@ -63,9 +227,12 @@ def run(dbname,
     cfg1 = postprocess_config(r['cfg'])
     seed = r['seed']
     cfg0 = postprocess_config(r['cfg0'])
+    cfg_id = r['_id']
+    checkpoint_markers = r.get('checkpoint_markers', False)
   else:
     init = True
     cfg1 = None
+    checkpoint_markers = True
     if cfgfile is not None:
       cfg0 = postprocess_config(json.load(open(cfgfile)))
     else:
@@ -73,35 +240,106 @@ def run(dbname,
 
   rng = np.random.RandomState(seed=seed)
 
-  outnodedict, innodedict, cfg = model_func(rng, batch_size, cfg0, slippage, slippage_error, **model_func_kwargs)
-  assert 'loss' in outnodedict
-  outnodenames, outnodes = map(list, zip(*outnodedict.items()))
+  # each step trains on accumulate_steps sub-batches of sub_batch_size
+  assert batch_size % accumulate_steps == 0, (batch_size, accumulate_steps)
+  sub_batch_size = batch_size // accumulate_steps
+  # data-parallel towers each get a shard of every sub-batch
+  devices = list(tower_devices) if tower_devices else [None]
+  assert sub_batch_size % len(devices) == 0, (sub_batch_size, len(devices))
+
+  train_kwargs = {'base_learningrate': base_learningrate,
+                  'decaystep': decaystep,
+                  'decayrate': decayrate}
+  if mixed_precision:
+    # float16 inputs and activations; the model keeps float32 variables and loss
+    model_func_kwargs = dict(model_func_kwargs, dtype='float16')
+    train_kwargs['loss_scale'] = loss_scale
+  if accumulate_steps > 1:
+    train_kwargs['accumulate_steps'] = accumulate_steps
+  if len(devices) > 1:
+    train_kwargs['tower_devices'] = devices
+  cached = None
+  if graph_cache_dir is not None and not init:
+    graph_key = get_graph_key(model_func, model_func_kwargs, batch_size,
+                              preprocess_config(cfg1), **train_kwargs)
+    cached = import_graph(graph_cache_dir, graph_key)
 
-  if not init:
-    assert cfg1 == cfg, (cfg1, cfg)
+  if cached is not None:
+    innodes, outnodedict = cached
+    innodedicts = split_tower_nodes(innodes, len(devices))
+    learning_rate = outnodedict.pop('learning_rate')
+    optimizer = outnodedict.pop('optimizer')
+    accumulate = outnodedict.pop('accumulate', None)
+    print('Loaded graph %s from cache' % graph_key)
   else:
-    assert not coll.find_one({'experiment_id': experiment_id, 'saved_filters': True})
-    rec = {'experiment_id': experiment_id,
-           'cfg': preprocess_config(cfg),
-           'seed': seed,
-           'cfg0': preprocess_config(cfg0),
-           'step': -1}
-    coll.insert(rec)
-
-  batch = tf.Variable(0, trainable=False)
-  learning_rate = tf.train.exponential_decay(
-      base_learningrate,                # Base learning rate.
-      batch * batch_size,  # Current index into the dataset.
-      decaystep,          # Decay step.
-      decayrate,                # Decay rate.
-      staircase=True)
-
-  optimizer = tf.train.MomentumOptimizer(learning_rate, 
-                                         0.9).minimize(outnodedict['loss'], 
-                                                       global_step=batch)
+    outnodedict, innodedicts, cfg = build_towers(model_func, rng, sub_batch_size // len(devices),
+                                                 cfg0, slippage, slippage_error,
+                                                 model_func_kwargs, devices)
+    assert 'loss' in outnodedict
+
+    if not init:
+      assert cfg1 == cfg, (cfg1, cfg)
+    else:
+      assert not coll.find_one({'experiment_id': experiment_id, 'saved_filters': True})
+      rec = {'experiment_id': experiment_id,
+             'cfg': preprocess_config(cfg),
+             'seed': seed,
+             'cfg0': preprocess_config(cfg0),
+             'checkpoint_markers': True,
+             'step': -1}
+      cfg_id = coll.insert(rec)
+
+    batch = tf.Variable(0, trainable=False)
+    learning_rate = tf.train.exponential_decay(
+        base_learningrate,                # Base learning rate.
+        batch * batch_size,  # Current index into the dataset.
+        decaystep,          # Decay step.
+        decayrate,                # Decay rate.
+        staircase=True)
 
+    optimizer = tf.train.MomentumOptimizer(learning_rate, 0.9)
+    # with towers, the gradient ops of each tower run on its device
+    colocate = len(devices) > 1
+    accumulate = None
+    if mixed_precision or accumulate_steps > 1:
+      loss = outnodedict['loss']
+      if mixed_precision:
+        # scaling the loss keeps small float16 gradients from flushing to zero;
+        # the float32 variables are updated with the unscaled gradients
+        loss = loss * loss_scale
+      grads_and_vars = [(g, v) for g, v in optimizer.compute_gradients(
+                            loss, colocate_gradients_with_ops=colocate)
+                        if g is not None]
+      if mixed_precision:
+        grads_and_vars = [(g / loss_scale, v) for g, v in grads_and_vars]
+      if accumulate_steps > 1:
+        accumulate, optimizer = get_accumulating_train_ops(optimizer, grads_and_vars,
+                                                           accumulate_steps, batch)
+      else:
+        optimizer = optimizer.apply_gradients(grads_and_vars, global_step=batch)
+    else:
+      optimizer = optimizer.minimize(outnodedict['loss'], global_step=batch,
+                                     colocate_gradients_with_ops=colocate)
+
+    if graph_cache_dir is not None:
+      graph_key = get_graph_key(model_func, model_func_kwargs, batch_size,
+                                preprocess_config(cfg), **train_kwargs)
+      train_nodes = {'learning_rate': learning_rate, 'optimizer': optimizer}
+      if accumulate is not None:
+        train_nodes['accumulate'] = accumulate
+      export_graph(graph_cache_dir, graph_key, join_tower_nodes(innodedicts),
+                   dict(outnodedict, **train_nodes))
+
+  outnodenames, outnodes = map(list, zip(*outnodedict.items()))
+  # with accumulation, each sub-batch accumulates and optimizer is run once per step
   outnodenames1 = outnodenames + ['learning_rate', 'optimizer']
-  outnodes1 = outnodes + [learning_rate, optimizer]
+  outnodes1 = outnodes + [learning_rate, optimizer if accumulate is None else accumulate]
+
+  if checkpoint_format == 'packed':
+    save_func = save_packed_checkpoint
+  else:
+    assert checkpoint_format == 'npy', checkpoint_format
+    save_func = save_checkpoint
 
   sdir = os.path.join(savedir, dbname, colname, experiment_id)
   if not os.path.exists(sdir):
@@ -114,71 +352,135 @@ def run(dbname,
       print('Initialized!')
       step0 = -1
     else:
-      step0 = max(coll.find({'experiment_id': experiment_id,
-                             'saved_filters': True}).distinct('step'))
-      Vars = tf.all_variables()
-      for v in Vars:
-        pth = get_checkpoint_path(sdir, v.name.replace('/', '__'), step0)
-        val = np.load(pth)
-        sess.run(v.assign(val))
-      print("Restored from %s at timestep %d" % (sdir, step0))
-
-    for step in xrange(step0 + 1, num_train_steps // batch_size):
-      batch_data = data_func(step, batch_size, **data_func_kwargs)
-      feed_dict = {innodedict[k]: batch_data[k] for k in innodedict}
-      outvals = sess.run(outnodes1, feed_dict=feed_dict)
-      outval_dict = dict(zip(outnodenames1[:-1], outvals[:-1]))
-      lossval = outval_dict['loss']
-      learning_rate_val = outval_dict['learning_rate']
-      print('Step: %d, loss: %f, learning rate: %f' % (step, 
-                                                       lossval,
-                                                       learning_rate_val))
-      if lossval > loss_threshold:
-        raise error.HiLossError("Loss: %.3f, Thres: %.3f" % (lossval, loss_threshold))
-
-      for outnodename, outnodeval in outval_dict.items():
-        spath = os.path.join(sdir, '%s.npy' % outnodename)
-        np.save(spath, outnodeval)
-      bfile = os.path.join(sdir, 'batchfile.txt')
-      with open(bfile, 'w') as _f:
-        _f.write(str(step))
+      steps = coll.find({'experiment_id': experiment_id,
+                         'saved_filters': True}).distinct('step')
+      step0 = get_latest_checkpoint_step(sdir, steps, markers=checkpoint_markers)
+      if step0 is None:
+        # stopped before its first checkpoint was fully written
+        tf.initialize_all_variables().run()
+        print('No complete checkpoint in %s, initialized!' % sdir)
+        step0 = -1
+      else:
+        Vars = tf.all_variables()
+        vnames = [v.name.replace('/', '__') for v in Vars]
+        vals = load_checkpoint(sdir, vnames, step0)
+        assign_variables(sess, Vars, vals)
+        print("Restored from %s at timestep %d" % (sdir, step0))
+    tf.initialize_local_variables().run()
+
+    num_steps = num_train_steps // batch_size
+    if prefetch > 0:
+      prefetcher = BatchPrefetcher(data_func, data_func_kwargs, sub_batch_size,
+                                   (step0 + 1) * accumulate_steps,
+                                   num_steps * accumulate_steps, depth=prefetch)
+    else:
+      prefetcher = None
+    checkpoint_writer = AsyncWriter()
+    output_writer = AsyncWriter()
+    inserter = BufferedInserter(coll, max_records=metrics_buffer_size,
+                                flush_interval=metrics_flush_interval)
+    timer = PhaseTimer(window=timing_window)
+    resources = [prefetcher, checkpoint_writer, output_writer, inserter]
+    try:
+      for step in xrange(step0 + 1, num_steps):
+        step_start = time.time()
+        lossvals = []
+        # data_func(i, sub_batch_size) for the sub-batches i of a step reads
+        # the examples data_func(step, batch_size) would
+        last_sub_step = (step + 1) * accumulate_steps - 1
+        for sub_step in xrange(step * accumulate_steps, last_sub_step + 1):
+          with timer.phase('data'):
+            if prefetcher is not None:
+              batch_data = prefetcher.get(sub_step)
+            else:
+              batch_data = data_func(sub_step, sub_batch_size, **data_func_kwargs)
+            feed_dict = get_feed_dict(innodedicts, batch_data)
+          with timer.phase('run'):
+            if trace_frequency and step % trace_frequency == 0 and sub_step == last_sub_step:
+              run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+              run_metadata = tf.RunMetadata()
+              outvals = sess.run(outnodes1, feed_dict=feed_dict,
+                                 options=run_options, run_metadata=run_metadata)
+              checkpoint_writer.submit(save_run_metadata, sdir, step, run_metadata)
+            else:
+              outvals = sess.run(outnodes1, feed_dict=feed_dict)
+          outval_dict = dict(zip(outnodenames1[:-1], outvals[:-1]))
+          lossvals.append(outval_dict['loss'])
+        if accumulate is not None:
+          with timer.phase('apply'):
+            sess.run(optimizer)
+          # the outputs are those of the last sub-batch, the loss the mean over the step
+          outval_dict['loss'] = np.mean(lossvals)
+        lossval = outval_dict['loss']
+        learning_rate_val = outval_dict['learning_rate']
+        print('Step: %d, loss: %f, learning rate: %f' % (step, 
+                                                         lossval,
+                                                         learning_rate_val))
+        if lossval > loss_threshold or not np.isfinite(lossval):
+          raise error.HiLossError("Loss: %.3f, Thres: %.3f" % (lossval, loss_threshold))
+
+        with timer.phase('outputs'):
+          if output_save_frequency and step % output_save_frequency == 0:
+            snapshot = get_output_snapshot(outval_dict,
+                                           nodes=output_save_nodes,
+                                           downsample=output_save_downsample,
+                                           dtype=output_save_dtype)
+            # snapshots are previews, so one is skipped while the last is still being written
+            output_writer.submit_nowait(save_outputs, sdir, snapshot, step)
       
-      if additional_metrics is None:
-        additional_metrics = {}
-      metrics = {}
-      for metric_name, metric_func in additional_metrics.items():
-        metric_val = metric_func(batch_data, outval_dict)
-        metrics[metric_name] = metric_val
-      if additional_metrics:
-        print(metrics)
-
-      if step % test_frequency == 0:
-        if dosave and (step % (test_frequency * save_multiple) == 0):
-          Vars = tf.all_variables()
-          for v in Vars:
-            pth = get_checkpoint_path(sdir, v.name.replace('/', '__'), step)
-            val = v.eval()
-            np.save(pth, val)
-            if erase_earlier:
-              dirn = os.path.split(pth)[0]
-              L = os.listdir(dirn)
-              nL = [int(_l[:-4]) for _l in L if _l.endswith('.npy') and isint(_l[:-4])]
-              nL.sort()
-              for _l in nL[:-erase_earlier]:
-                delpth = os.path.join(dirn, str(_l) + '.npy')
-                os.remove(delpth)            
-          saved_filters = True
-        else:
-          saved_filters = False
-        rec = {'experiment_id': experiment_id,
-               'cfg': preprocess_config(cfg),
-               'saved_filters': saved_filters,
-               'step': step,
-               'loss': float(lossval),
-               'learning_rate': float(learning_rate_val)}
-        if metrics:
-          rec['metrics'] = metrics
-        coll.insert(rec)
+        if additional_metrics is None:
+          additional_metrics = {}
+        metrics = {}
+        with timer.phase('metrics'):
+          for metric_name, metric_func in additional_metrics.items():
+            metric_val = metric_func(batch_data, outval_dict)
+            metrics[metric_name] = metric_val
+        if additional_metrics:
+          print(metrics)
+
+        if step % test_frequency == 0:
+          if dosave and (step % (test_frequency * save_multiple) == 0):
+            with timer.phase('checkpoint'):
+              Vars = tf.all_variables()
+              vals = sess.run(Vars)
+              vnames = [v.name.replace('/', '__') for v in Vars]
+              checkpoint_writer.submit(save_func, sdir, vnames, vals, step,
+                                       erase_earlier=erase_earlier)
+            saved_filters = True
+          else:
+            saved_filters = False
+          rec = {'experiment_id': experiment_id,
+                 'cfg_id': cfg_id,
+                 'saved_filters': saved_filters,
+                 'step': step,
+                 'loss': float(lossval),
+                 'learning_rate': float(learning_rate_val),
+                 'timing': timer.summary()}
+          if metrics:
+            rec['metrics'] = metrics
+          with timer.phase('db'):
+            inserter.add(rec)
+            if saved_filters:
+              inserter.flush()
+        timer.add('step', time.time() - step_start)
+    except Exception:
+      # closing must not replace the training error, e.g. a HiLossError
+      exc_info = sys.exc_info()
+      try:
+        close_all(resources)
+      except Exception:
+        traceback.print_exc()
+      six.reraise(*exc_info)
+    else:
+      close_all(resources)
+
+  if reference_experiment_id is not None:
+    mismatches = compare_losses(coll, experiment_id, reference_experiment_id,
+                                rtol=reference_rtol, max_step=reference_max_step)
+    if mismatches:
+      raise error.LossMismatchError(
+          "%d steps differ from %s by more than %g, first (step, loss, reference): %s"
+          % (len(mismatches), reference_experiment_id, reference_rtol, mismatches[0]))
 
 
 def get_cli():
@@ -203,6 +505,21 @@ def get_cli():
   parser.add_argument('--decayrate', type=float, default=0.95)
   parser.add_argument('--num_train_steps', type=int, default=2048000)
   parser.add_argument('--erase_earlier', type=int, default=0)
+  parser.add_argument('--checkpoint_format', type=str, default='npy', help="'npy' (one file per variable) or 'packed' (one file per step)")
+  parser.add_argument('--output_save_frequency', type=int, default=1, help="save output nodes every this many steps (0 never)")
+  parser.add_argument('--output_save_nodes', type=str, nargs='+', default=None, help="names of output nodes to save")
+  parser.add_argument('--output_save_downsample', type=int, default=None, help="spatial subsampling of saved image outputs")
+  parser.add_argument('--output_save_dtype', type=str, default=None, help="dtype to cast saved float outputs to, e.g. float16")
+  parser.add_argument('--trace_frequency', type=int, default=0, help="save a TensorFlow trace every this many steps (0 never)")
+  parser.add_argument('--graph_cache_dir', type=str, default=None, help="directory of built graphs to reuse across runs of the same config")
+  parser.add_argument('--prefetch', type=int, default=0, help="number of batches to fetch ahead of training")
+  parser.add_argument('--mixed_precision', type=int, default=0, help="train with float16 inputs and activations and float32 weights")
+  parser.add_argument('--loss_scale', type=float, default=128., help="loss scale of mixed precision training")
+  parser.add_argument('--reference_experiment_id', type=str, default=None, help="experiment whose recorded losses this run's must match, e.g. its float32 version")
+  parser.add_argument('--reference_rtol', type=float, default=0.05, help="relative tolerance of the loss comparison")
+  parser.add_argument('--reference_max_step', type=int, default=None, help="last step of the loss comparison")
+  parser.add_argument('--accumulate_steps', type=int, default=1, help="number of sub-batches whose gradients are accumulated per step")
+  parser.add_argument('--tower_devices', type=str, nargs='+', default=None, help="devices of data-parallel model towers, e.g. /gpu:0 /gpu:1, or /cpu:0 repeated")
   return parser
   
 
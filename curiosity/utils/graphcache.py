@@ -0,0 +1,117 @@
+"""
+cache of built training graphs, keyed by the canonical model config
+
+base.run exports the meta-graph of every graph it builds, together with the
+names of its input and output nodes.  A later run of the same architecture
+(a resumed or promoted trial) imports it instead of calling the model
+function again.  The key covers everything the graph is built from: the
+model function and the source of its module and of the curiosity modules
+it uses (such as the shared builder), its kwargs, the batch size, the config
+with its sampled values, and the learning rate schedule.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import json
+import inspect
+import hashlib
+
+import tensorflow as tf
+
+# part of every key; bumped when the key stops covering something the graph
+# depends on, so that entries exported under the old key are never imported
+# (2: the builder's source, after the model modules moved onto it)
+KEY_VERSION = 2
+
+
+def get_module_source(name):
+  path = sys.modules[name].__file__
+  if path.endswith('.pyc'):
+    path = path[:-1]
+  with open(path, 'rb') as f:
+    return f.read()
+
+
+def get_module_deps(name, package='curiosity'):
+  """
+  Names of module name and of every module of package it uses, directly or
+  through other modules of package, e.g. curiosity.models.builder for the
+  model modules.  A module counts as used when it, or a function or class
+  defined in it, is a global of a module already found.
+  """
+  found = set()
+  todo = [name]
+  while todo:
+    name = todo.pop()
+    if name in found:
+      continue
+    found.add(name)
+    for val in vars(sys.modules[name]).values():
+      if inspect.ismodule(val):
+        dep = val.__name__
+      else:
+        dep = getattr(val, '__module__', None)
+      if isinstance(dep, str) and dep.split('.')[0] == package and \
+         getattr(sys.modules.get(dep), '__file__', None):
+        todo.append(dep)
+  return sorted(found)
+
+
+def get_graph_key(model_func, model_func_kwargs, batch_size, cfg, **train_kwargs):
+  desc = {'model_func': '%s.%s' % (model_func.__module__, model_func.__name__),
+          'model_func_kwargs': model_func_kwargs,
+          'batch_size': batch_size,
+          'cfg': cfg,
+          'train_kwargs': train_kwargs,
+          'tf_version': tf.__version__,
+          'key_version': KEY_VERSION}
+  h = hashlib.sha1(json.dumps(desc, sort_keys=True, default=str).encode('utf-8'))
+  for name in get_module_deps(model_func.__module__):
+    h.update(name.encode('utf-8'))
+    h.update(get_module_source(name))
+  return h.hexdigest()
+
+
+def get_graph_paths(dirn, key):
+  return (os.path.join(dirn, '%s.meta' % key),
+          os.path.join(dirn, '%s.json' % key))
+
+
+def export_graph(dirn, key, innodedict, outnodedict):
+  """
+  exports the default graph; the node names are written last, and are what
+  import_graph looks for, so a partly written entry is never picked up
+  """
+  meta_path, names_path = get_graph_paths(dirn, key)
+  if os.path.exists(names_path):
+    return
+  if not os.path.exists(dirn):
+    os.makedirs(dirn)
+  tmp_suffix = '.%d.tmp' % os.getpid()
+  tf.train.export_meta_graph(filename=meta_path + tmp_suffix)
+  os.rename(meta_path + tmp_suffix, meta_path)
+  names = {'innodes': dict((k, v.name) for k, v in innodedict.items()),
+           'outnodes': dict((k, v.name) for k, v in outnodedict.items())}
+  with open(names_path + tmp_suffix, 'w') as f:
+    json.dump(names, f)
+  os.rename(names_path + tmp_suffix, names_path)
+
+
+def import_graph(dirn, key):
+  """
+  imports a cached graph into the default graph and returns its input and
+  output node dicts, or None if there is no entry for key
+  """
+  meta_path, names_path = get_graph_paths(dirn, key)
+  if not os.path.exists(names_path):
+    return None
+  with open(names_path) as f:
+    names = json.load(f)
+  tf.train.import_meta_graph(meta_path)
+  graph = tf.get_default_graph()
+  innodedict = dict((k, graph.as_graph_element(v)) for k, v in names['innodes'].items())
+  outnodedict = dict((k, graph.as_graph_element(v)) for k, v in names['outnodes'].items())
+  return innodedict, outnodedict
@@ -12,7 +12,8 @@ class HDF5DataProvider(object):
                  mini_batch_size=None,
                  preprocess=None,
                  postprocess=None,
-                 pad=False):
+                 pad=False,
+                 fancy_index_density=None):
         self.hdf5source = hdf5source
         self.sourcelist = sourcelist
         self.file = h5py.File(self.hdf5source, 'r')
@@ -53,6 +54,12 @@ class HDF5DataProvider(object):
         if mini_batch_size is None:
             mini_batch_size = self.batch_size
         self.mini_batch_size = mini_batch_size
+        if self.subsliceinds is not None:
+            # chunk of mini_batch_size rows holding each selected row, and the
+            # row's offset within it, computed once for all batches
+            self.subslice_chunks = self.subsliceinds // mini_batch_size
+            self.subslice_offsets = self.subsliceinds - self.subslice_chunks * mini_batch_size
+        self.fancy_index_density = fancy_index_density
         self.total_batches = int(math.ceil(self.data_length / float(self.batch_size)))
         self.curr_batch_num = 0
         self.curr_epoch = 1
@@ -92,16 +99,28 @@ class HDF5DataProvider(object):
             return dsource[sliceval]
         else:
             subslice_inds = self.subsliceinds[sliceval]
+            if isinstance(dsource, np.ndarray):
+                return dsource[subslice_inds]
+            n = len(subslice_inds)
+            if n == 0:
+                return dsource[0:0]
+            if self.fancy_index_density is not None:
+                span = subslice_inds[-1] - subslice_inds[0] + 1
+                if n >= self.fancy_index_density * span:
+                    return dsource[subslice_inds.tolist()]
+            chunks = self.subslice_chunks[sliceval]
+            offsets = self.subslice_offsets[sliceval]
+            bounds = np.flatnonzero(chunks[1:] != chunks[:-1]) + 1
+            starts = np.concatenate([[0], bounds])
+            ends = np.concatenate([bounds, [n]])
             mbs = self.mini_batch_size
-            bn0 = subslice_inds.min() / mbs
-            bn1 = subslice_inds.max() / mbs
-            stims = []
-            for _bn in range(bn0, bn1 + 1):
-                _s = np.asarray(dsource[_bn * mbs: (_bn + 1) * mbs])
-                new_inds = fast.isin(np.arange(_bn * mbs, (_bn + 1) * mbs), subslice_inds)
-                new_array = _s[new_inds]
-                stims.append(new_array)
-            stims = np.concatenate(stims)
+            stims = np.empty((n,) + dsource.shape[1:], dtype=dsource.dtype)
+            for s, e in zip(starts, ends):
+                # read only the span of the chunk that holds selected rows
+                o0 = chunks[s] * mbs + offsets[s]
+                o1 = chunks[s] * mbs + offsets[e - 1] + 1
+                _s = np.asarray(dsource[o0: o1])
+                stims[s: e] = _s[offsets[s: e] - offsets[s]]
             return stims
 
 
@@ -1,7 +1,51 @@
+import numpy as np
+
 PIXEL_DEPTH = 255
 
-def norml(x):
-  return (x - PIXEL_DEPTH/2.0) / PIXEL_DEPTH
+def norml(x, out=None, dtype=np.float32):
+  """
+  scale pixel values to [-0.5, 0.5] in dtype (float32 by default, never via
+  a float64 temporary), writing into the preallocated array out if given
+  """
+  if out is None:
+    out = np.empty(np.shape(x), dtype=dtype)
+  np.subtract(x, PIXEL_DEPTH / 2.0, out=out, dtype=out.dtype)
+  np.divide(out, PIXEL_DEPTH, out=out)
+  return out
+
+
+class BufferRing(object):
+  """
+  Cycles through num_buffers preallocated arrays per name so that data
+  sources can normalize batches into reused memory.  A buffer is handed out
+  again after num_buffers further requests for the same name, so num_buffers
+  has to exceed the number of batches alive at once -- with base.run that is
+  the prefetch depth plus two.  With num_buffers=0, get returns None and
+  callers allocate fresh arrays.
+  """
+  def __init__(self, num_buffers):
+    self.num_buffers = num_buffers
+    self.buffers = {}
+    self.counters = {}
+
+  def get(self, name, shape, dtype):
+    if self.num_buffers == 0:
+      return None
+    shape = tuple(shape)
+    dtype = np.dtype(dtype)
+    bufs = self.buffers.setdefault(name, [])
+    ind = self.counters.get(name, 0) % self.num_buffers
+    self.counters[name] = ind + 1
+    if ind == len(bufs):
+      bufs.append(np.empty(shape, dtype=dtype))
+    elif bufs[ind].shape != shape or bufs[ind].dtype != dtype:
+      bufs[ind] = np.empty(shape, dtype=dtype)
+    return bufs[ind]
+
+
+def norml_into(buffers, name, x, dtype=np.float32):
+  """norml into the next buffer for name from a BufferRing"""
+  return norml(x, out=buffers.get(name, np.shape(x), dtype), dtype=dtype)
 
 
 def l2_error_rate(prediction, actual):
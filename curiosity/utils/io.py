@@ -1,46 +1,290 @@
 from StringIO import StringIO
+import os
+import errno
+import json
+import zlib
 
 from PIL import Image
 import numpy as np
 import zmq
 
+try:
+  import lz4.frame as lz4frame
+except ImportError:
+  lz4frame = None
 
-def send_array(socket, A, flags=0, copy=True, track=False):
-    """send a numpy array with metadata"""
-    md = dict(
-        dtype = str(A.dtype),
-        shape = A.shape,
-    )
-    socket.send_json(md, flags|zmq.SNDMORE)
-    return socket.send(A, flags, copy=copy, track=track)
 
+TRANSPORT_VERSION = 2
 
-def recv_array(socket, flags=0, copy=True, track=False):
-  """recv a numpy array"""
+SHAPE_CACHE_DIR = os.environ.get('CURIOSITY_CACHE_DIR',
+                                 os.path.join(os.path.expanduser('~'), '.curiosity'))
+shape_cache = {}
+
+
+def available_codecs():
+  """names of the compressors that can be combined with 'delta+'"""
+  codecs = ['zlib']
+  if lz4frame is not None:
+    codecs.append('lz4')
+  return codecs
+
+
+def negotiate_codecs(codecs):
+  """
+  Restricts the codecs a client asks for to ones it can decode: a
+  compressor that is not installed here is replaced by zlib, keeping any
+  'delta+' prefix.  None (all raw) is passed through.
+  """
+  if codecs is None:
+    return None
+  negotiated = []
+  for codec in codecs:
+    if codec is not None and codec != 'raw':
+      parts = codec.split('+')
+      if parts[-1] not in available_codecs():
+        codec = '+'.join(parts[:-1] + ['zlib'])
+    negotiated.append(codec)
+  return negotiated
+
+
+def get_delta_axis(A):
+  """rows of pixels for image arrays, otherwise the leading axis"""
+  return A.ndim - 2 if A.ndim >= 3 else 0
+
+
+def encode_array(A, codec):
+  """
+  Encodes the contiguous array A with codec, which is 'raw', a compressor
+  name, or 'delta+' followed by a compressor name.  Delta coding is only
+  applied to integer arrays, where it wraps around exactly.  Returns the
+  codec actually used along with the payload, falling back to zlib if the
+  requested compressor is not installed here.
+  """
+  if codec is None or codec == 'raw':
+    return 'raw', A
+  parts = codec.split('+')
+  compressor = parts[-1]
+  if compressor not in available_codecs():
+    compressor = 'zlib'
+  if 'delta' in parts[:-1] and A.dtype.kind in 'iu' and A.ndim > 0 and A.size > 0:
+    axis = get_delta_axis(A)
+    D = A.copy()
+    sl0 = [slice(None)] * A.ndim
+    sl1 = [slice(None)] * A.ndim
+    sl0[axis] = slice(1, None)
+    sl1[axis] = slice(None, -1)
+    D[tuple(sl0)] -= A[tuple(sl1)]
+    A = D
+    compressor = 'delta+' + compressor
+  if compressor.endswith('lz4'):
+    payload = lz4frame.compress(A)
+  else:
+    payload = zlib.compress(A, 1)
+  return compressor, payload
+
+
+def decode_array(buf, md):
+  codec = md.get('codec', 'raw')
+  if codec == 'raw':
+    A = np.frombuffer(buf, dtype=md['dtype'])
+    return A.reshape(md['shape'])
+  parts = codec.split('+')
+  compressor = parts[-1]
+  if compressor not in available_codecs() or parts[:-1] not in ([], ['delta']):
+    raise IOError('cannot decode arrays sent with codec %s, available: %s' %
+                  (codec, ', '.join(available_codecs())))
+  if compressor == 'lz4':
+    data = lz4frame.decompress(buf)
+  else:
+    data = zlib.decompress(buf)
+  A = np.frombuffer(data, dtype=md['dtype']).reshape(md['shape'])
+  if codec.startswith('delta+'):
+    A = np.cumsum(A, axis=md['delta_axis'], dtype=A.dtype)
+  return A
+
+
+def send_array(socket, A, flags=0, copy=False, track=False, codec=None):
+  """
+  send a numpy array with a versioned header carrying dtype, shape and codec
+
+  Uncompressed arrays are sent without copying, so A must not be modified
+  until the message has been sent (pass track=True to find out when).
+  """
+  A = np.asarray(A)
+  if not A.flags.c_contiguous:
+    A = A.copy(order='C')
+  codec, payload = encode_array(A, codec)
+  md = dict(
+    version = TRANSPORT_VERSION,
+    dtype = str(A.dtype),
+    shape = A.shape,
+    codec = codec,
+  )
+  if codec.startswith('delta+'):
+    md['delta_axis'] = get_delta_axis(A)
+  socket.send_json(md, flags|zmq.SNDMORE)
+  return socket.send(payload, flags, copy=copy, track=track)
+
+
+def recv_array(socket, flags=0, copy=False, track=False):
+  """
+  recv a numpy array; headers without a codec (version 1) carry raw data
+
+  Uncompressed arrays received without copying are read-only views on the
+  message buffer.
+  """
   md = socket.recv_json(flags=flags)
+  if 'error' in md:  # hdf5_handler could not serve the request
+    raise IOError(md['error'])
   msg = socket.recv(flags=flags, copy=copy, track=track)
   buf = buffer(msg)
-  A = np.frombuffer(buf, dtype=md['dtype'])
-  return A.reshape(md['shape'])
+  return decode_array(buf, md)
+
+
+class BatchClient(object):
+  """
+  DEALER client for hdf5_handler that can keep several requests in flight.
+  Replies may come back out of order; receive returns the id of the request
+  each reply answers.
+  """
+  def __init__(self, ctx, host, port):
+    self.sock = ctx.socket(zmq.DEALER)
+    self.sock.connect("tcp://%s:%d" % (host, port))
+    self.counter = 0
+
+  def request(self, msg):
+    msg = dict(msg)
+    if msg.get('codecs') is not None:
+      msg['codecs'] = negotiate_codecs(msg['codecs'])
+    msg['request_id'] = self.counter
+    self.counter += 1
+    self.sock.send(b'', zmq.SNDMORE)
+    self.sock.send_json(msg)
+    return msg['request_id']
+
+  def receive(self, num_arrays):
+    self.sock.recv()
+    header = self.sock.recv_json()
+    if 'error' in header:
+      raise IOError('request %d failed: %s' % (header['request_id'], header['error']))
+    arrays = [recv_array(self.sock) for _ in range(num_arrays)]
+    return header['request_id'], arrays
+
+
+def get_shape_cache_path(cache_dir=None):
+  return os.path.join(cache_dir or SHAPE_CACHE_DIR, 'example_shapes.json')
+
+
+def load_shape_cache(path):
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return {}
+
+
+def save_shape_cache(path, shapes):
+  """merges shapes into the cache file; the file is replaced atomically"""
+  dirn = os.path.dirname(path)
+  if not os.path.exists(dirn):
+    os.makedirs(dirn)
+  cached = load_shape_cache(path)
+  cached.update(shapes)
+  tmp_path = '%s.%d.tmp' % (path, os.getpid())
+  with open(tmp_path, 'w') as f:
+    json.dump(cached, f, sort_keys=True)
+  os.rename(tmp_path, path)
+
+
+def get_dataset_metadata(host, port, datapath, group=None):
+  """
+  Asks hdf5_handler at host:port to describe every dataset in the file at
+  datapath (or under group in it), without transferring any data.  Returns
+  a dict from dataset path, e.g. 'randomperm/images', to its shape, dtype,
+  chunks, compression, compression_opts and length.
+  """
+  ctx = zmq.Context.instance()
+  sock = ctx.socket(zmq.REQ)
+  sock.connect("tcp://%s:%d" % (host, port))
+  try:
+    sock.send_json({'metadata': True,
+                    'path': datapath,
+                    'group': group})
+    metadata = sock.recv_json()
+  finally:
+    sock.close(linger=0)
+  if isinstance(metadata.get('error'), basestring):
+    raise IOError(metadata['error'])
+  return metadata
+
+
+def get_key_path(k):
+  """dataset path of a key given as a name or a list of group names"""
+  if isinstance(k, (list, tuple)):
+    return '/'.join(k)
+  return k
+
+
+def get_example_shapes(host, port, datapath, keys, cache_dir=None):
+  """
+  Gets the shape of a single example of each of keys in the dataset at
+  datapath, served by hdf5_handler at host:port.  Shapes are cached per
+  (datapath, key) in memory and in a JSON file under cache_dir (by default
+  $CURIOSITY_CACHE_DIR or ~/.curiosity); a miss fetches the metadata of the
+  whole file, so only the first lookup in a file ever talks to the handler.
+  Remove the cache file after rewriting a dataset.
+  """
+  names = [json.dumps([datapath, get_key_path(k)]) for k in keys]
+  if any(n not in shape_cache for n in names):
+    path = get_shape_cache_path(cache_dir)
+    shape_cache.update(load_shape_cache(path))
+    if any(n not in shape_cache for n in names):
+      metadata = get_dataset_metadata(host, port, datapath)
+      fetched = dict((json.dumps([datapath, name]), md['shape'][1:])
+                     for name, md in metadata.items())
+      shape_cache.update(fetched)
+      save_shape_cache(path, fetched)
+  for n, k in zip(names, keys):
+    if n not in shape_cache:
+      raise KeyError('no dataset %s in %s' % (get_key_path(k), datapath))
+  return [tuple(shape_cache[n]) for n in names]
+
+
+def recv_message(sock):
+  """receive the info and the encoded normals, objects and image of a frame"""
+  info = sock.recv()
+  nstr = sock.recv()
+  ostr = sock.recv()
+  imstr = sock.recv()
+  return info, nstr, ostr, imstr
+
+
+def decode_image(s):
+  return np.asarray(Image.open(StringIO(s)).convert('RGB'))
+
+
+def write_message(info, nstr, ostr, imstr, outdir, imtype='png', prefix=''):
+  # several writer threads and simulators may create outdir at once
+  try:
+    os.makedirs(outdir)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+  with open(os.path.join(outdir, 'image_%s.%s' % (prefix, imtype)), 'w') as _f:
+    _f.write(imstr)
+  with open(os.path.join(outdir, 'objects_%s.%s' % (prefix, imtype)), 'w') as _f:
+    _f.write(ostr)
+  with open(os.path.join(outdir, 'normals_%s.%s' % (prefix, imtype)), 'w') as _f:
+    _f.write(nstr)
+  with open(os.path.join(outdir, 'info_%s.json' % prefix), 'w') as _f:
+    _f.write(info)
 
 
 def handle_message(sock, write=False, outdir='', imtype='png', prefix=''):
-    info = sock.recv()
-    nstr = sock.recv()
-    narray = np.asarray(Image.open(StringIO(nstr)).convert('RGB'))
-    ostr = sock.recv()
-    oarray = np.asarray(Image.open(StringIO(ostr)).convert('RGB'))
-    imstr = sock.recv()
-    imarray = np.asarray(Image.open(StringIO(imstr)).convert('RGB'))
-    if write:
-        if not os.path.exists(outdir):
-            os.mkdir(outdir)
-        with open(os.path.join(outdir, 'image_%s.%s' % (prefix, imtype)), 'w') as _f:
-            _f.write(imstr)
-        with open(os.path.join(outdir, 'objects_%s.%s' % (prefix, imtype)), 'w') as _f:
-            _f.write(ostr)
-        with open(os.path.join(outdir, 'normals_%s.%s' % (prefix, imtype)), 'w') as _f:
-            _f.write(nstr)
-        with open(os.path.join(outdir, 'info_%s.json' % prefix), 'w') as _f:
-            _f.write(info)
-    return [info, narray, oarray, imarray]
+  info, nstr, ostr, imstr = recv_message(sock)
+  narray = decode_image(nstr)
+  oarray = decode_image(ostr)
+  imarray = decode_image(imstr)
+  if write:
+    write_message(info, nstr, ostr, imstr, outdir, imtype=imtype, prefix=prefix)
+  return [info, narray, oarray, imarray]
@@ -1,5 +1,22 @@
 import os
+import sys
 import copy
+import json
+import struct
+import threading
+
+import numpy as np
+import six
+from six.moves import queue
+
+
+def isint(x):
+  try:
+    int(x)
+  except:
+    return False
+  else:
+    return True
 
 
 def get_checkpoint_path(dirn, vname, step):
@@ -9,6 +26,214 @@ def get_checkpoint_path(dirn, vname, step):
   return os.path.join(cdir, '%d.npy' % step)
 
 
+def get_checkpoint_marker_path(dirn, step):
+  return os.path.join(dirn, 'checkpoint_%d.complete' % step)
+
+
+def checkpoint_complete(dirn, step):
+  return os.path.exists(get_checkpoint_marker_path(dirn, step))
+
+
+def get_latest_checkpoint_step(dirn, steps, markers=True):
+  """
+  Returns the latest of the given steps whose checkpoint was fully written, or
+  None if there is none.  Runs started before completion markers existed
+  (markers=False) have none at all; for those the latest step is returned as
+  before.
+  """
+  steps = sorted(steps)
+  complete = [s for s in steps if checkpoint_complete(dirn, s)]
+  if complete:
+    return complete[-1]
+  if markers or not steps:
+    return None
+  return steps[-1]
+
+
+def write_checkpoint_marker(dirn, step):
+  mpth = get_checkpoint_marker_path(dirn, step)
+  with open(mpth, 'w') as _f:
+    _f.write(str(step))
+    _f.flush()
+    os.fsync(_f.fileno())
+
+
+def save_checkpoint(dirn, vnames, vals, step, erase_earlier=None):
+  """
+  Writes one .npy file per variable and then the completion marker for step,
+  so a step only counts as saved once every file is on disk.
+  """
+  for vname, val in zip(vnames, vals):
+    pth = get_checkpoint_path(dirn, vname, step)
+    with open(pth, 'wb') as _f:
+      np.save(_f, val)
+      _f.flush()
+      os.fsync(_f.fileno())
+  write_checkpoint_marker(dirn, step)
+  if erase_earlier:
+    erase_earlier_checkpoints(dirn, vnames, erase_earlier)
+
+
+PACKED_MAGIC = b'CURCKPT1'
+PACKED_ALIGNMENT = 64
+
+
+def get_packed_checkpoint_path(dirn, step):
+  return os.path.join(dirn, 'checkpoint_%d.pack' % step)
+
+
+def packed_align(n):
+  return -(-n // PACKED_ALIGNMENT) * PACKED_ALIGNMENT
+
+
+def save_packed_checkpoint(dirn, vnames, vals, step, erase_earlier=None):
+  """
+  Writes all variables for step into a single file:  an 8-byte magic string,
+  the 8-byte length of a JSON index header, the header itself and then the
+  raw array data, each array starting at a 64-byte aligned offset.  The file
+  is written under a temporary name and renamed into place once flushed.
+  """
+  vals = [np.asarray(val) for val in vals]
+  vals = [val if val.flags.c_contiguous else val.copy(order='C') for val in vals]
+  index = []
+  offset = 0
+  for vname, val in zip(vnames, vals):
+    index.append({'name': vname,
+                  'dtype': val.dtype.str,
+                  'shape': list(val.shape),
+                  'offset': offset})
+    offset = packed_align(offset + val.nbytes)
+  header = json.dumps({'version': 1,
+                       'step': step,
+                       'variables': index}).encode('utf-8')
+  data_start = packed_align(len(PACKED_MAGIC) + 8 + len(header))
+  pth = get_packed_checkpoint_path(dirn, step)
+  tmppth = pth + '.tmp'
+  with open(tmppth, 'wb') as _f:
+    _f.write(PACKED_MAGIC)
+    _f.write(struct.pack('<Q', len(header)))
+    _f.write(header)
+    for entry, val in zip(index, vals):
+      _f.seek(data_start + entry['offset'])
+      val.tofile(_f)
+    _f.flush()
+    os.fsync(_f.fileno())
+  os.rename(tmppth, pth)
+  write_checkpoint_marker(dirn, step)
+  if erase_earlier:
+    erase_earlier_checkpoints(dirn, [], erase_earlier)
+
+
+def load_packed_checkpoint(dirn, step):
+  """
+  Returns a dictionary from variable name to a read-only array backed by a
+  memory map of the packed checkpoint file.
+  """
+  pth = get_packed_checkpoint_path(dirn, step)
+  with open(pth, 'rb') as _f:
+    magic = _f.read(len(PACKED_MAGIC))
+    assert magic == PACKED_MAGIC, (pth, magic)
+    hlen, = struct.unpack('<Q', _f.read(8))
+    header = json.loads(_f.read(hlen).decode('utf-8'))
+  data_start = packed_align(len(PACKED_MAGIC) + 8 + hlen)
+  mm = np.memmap(pth, dtype=np.uint8, mode='r')
+  vals = {}
+  for entry in header['variables']:
+    dtype = np.dtype(entry['dtype'])
+    shape = tuple(entry['shape'])
+    start = data_start + entry['offset']
+    end = start + int(np.prod(shape)) * dtype.itemsize
+    vals[entry['name']] = mm[start: end].view(dtype).reshape(shape)
+  return vals
+
+
+def load_checkpoint(dirn, vnames, step):
+  if os.path.exists(get_packed_checkpoint_path(dirn, step)):
+    packed = load_packed_checkpoint(dirn, step)
+    return [packed[vname] for vname in vnames]
+  else:
+    return [np.load(get_checkpoint_path(dirn, vname, step)) for vname in vnames]
+
+
+def erase_earlier_checkpoints(dirn, vnames, keep):
+  for vname in vnames:
+    erase_earlier_files(os.path.join(dirn, vname), '', '.npy', keep)
+  erase_earlier_files(dirn, 'checkpoint_', '.pack', keep)
+  erase_earlier_files(dirn, 'checkpoint_', '.complete', keep)
+
+
+def erase_earlier_files(dirn, prefix, suffix, keep):
+  L = os.listdir(dirn)
+  nL = [_l[len(prefix): len(_l) - len(suffix)] for _l in L
+        if _l.startswith(prefix) and _l.endswith(suffix)]
+  nL = sorted([int(_n) for _n in nL if isint(_n)])
+  for _n in nL[:-keep]:
+    os.remove(os.path.join(dirn, prefix + str(_n) + suffix))
+
+
+def save_outputs(dirn, outputs, step):
+  for name, val in outputs.items():
+    np.save(os.path.join(dirn, '%s.npy' % name), val)
+  with open(os.path.join(dirn, 'batchfile.txt'), 'w') as _f:
+    _f.write(str(step))
+
+
+class AsyncWriter(object):
+  """
+  Runs save jobs on a background thread, in the order they were submitted.
+  At most max_pending jobs wait in the queue, which bounds the memory held by
+  snapshots that have not been written yet.  An exception raised by a job is
+  re-raised in the training thread on the next submit, flush or close.
+  """
+  def __init__(self, max_pending=1):
+    self.queue = queue.Queue(maxsize=max_pending)
+    self.exc_info = None
+    self.thread = threading.Thread(target=self.work)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def work(self):
+    while True:
+      job = self.queue.get()
+      try:
+        if job is None:
+          return
+        if self.exc_info is None:
+          func, args, kwargs = job
+          func(*args, **kwargs)
+      except Exception:
+        self.exc_info = sys.exc_info()
+      finally:
+        self.queue.task_done()
+
+  def check(self):
+    if self.exc_info is not None:
+      exc_info, self.exc_info = self.exc_info, None
+      six.reraise(*exc_info)
+
+  def submit(self, func, *args, **kwargs):
+    self.check()
+    self.queue.put((func, args, kwargs))
+
+  def submit_nowait(self, func, *args, **kwargs):
+    """submit unless the queue is full; returns whether the job was queued"""
+    self.check()
+    try:
+      self.queue.put_nowait((func, args, kwargs))
+    except queue.Full:
+      return False
+    return True
+
+  def flush(self):
+    self.queue.join()
+    self.check()
+
+  def close(self):
+    self.queue.put(None)
+    self.thread.join()
+    self.check()
+
+
 def preprocess_config(cfg):
   cfg = copy.deepcopy(cfg)
   for k in ['encode', 'decode', 'hidden']:
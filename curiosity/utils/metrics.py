@@ -0,0 +1,111 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import threading
+
+import six
+
+
+def insert_many(coll, records):
+  if hasattr(coll, 'insert_many'):
+    coll.insert_many(records)
+  else:
+    coll.insert(records)
+
+
+class BufferedInserter(object):
+  """Inserts records into a Mongo collection in bulk from a background thread.
+
+  Records are written once max_records have accumulated, flush_interval
+  seconds have passed, or flush() is called; flush() blocks until every
+  record added so far is in the database.  An insert error is re-raised in
+  the training thread on the next add, flush or close.
+  """
+  def __init__(self, coll, max_records=100, flush_interval=10.):
+    self.coll = coll
+    self.max_records = max_records
+    self.flush_interval = flush_interval
+    self.records = []
+    self.num_added = 0
+    self.num_done = 0
+    self.flushing = False
+    self.closed = False
+    self.exc_info = None
+    self.cond = threading.Condition()
+    self.thread = threading.Thread(target=self.work)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def work(self):
+    while True:
+      with self.cond:
+        if not (self.flushing or self.closed or
+                len(self.records) >= self.max_records):
+          self.cond.wait(self.flush_interval)
+        records, self.records = self.records, []
+        self.flushing = False
+        closed = self.closed
+      if records:
+        try:
+          insert_many(self.coll, records)
+        except Exception:
+          self.exc_info = sys.exc_info()
+      with self.cond:
+        self.num_done += len(records)
+        self.cond.notify_all()
+      if closed:
+        return
+
+  def check(self):
+    if self.exc_info is not None:
+      exc_info, self.exc_info = self.exc_info, None
+      six.reraise(*exc_info)
+
+  def add(self, rec):
+    self.check()
+    with self.cond:
+      self.records.append(rec)
+      self.num_added += 1
+      if len(self.records) >= self.max_records:
+        self.cond.notify_all()
+
+  def flush(self):
+    with self.cond:
+      target = self.num_added
+      self.flushing = True
+      self.cond.notify_all()
+      while self.num_done < target:
+        self.cond.wait()
+    self.check()
+
+  def close(self):
+    with self.cond:
+      self.closed = True
+      self.cond.notify_all()
+    self.thread.join()
+    self.check()
+
+
+def compare_losses(coll, experiment_id, reference_id, rtol=0.05, max_step=None):
+  """
+  Compares the losses base.run recorded for experiment_id with those of
+  reference_id at the steps both recorded, e.g. a float16 run with the
+  float32 run of the same config, seed and data.  Runs drift apart as they
+  train, so max_step limits the comparison to early steps.
+  :return: (step, loss, reference loss) of the steps whose losses differ by
+  more than rtol of the reference loss
+  """
+  query = {'loss': {'$exists': True}}
+  if max_step is not None:
+    query['step'] = {'$lte': max_step}
+  ref = {}
+  for rec in coll.find(dict(query, experiment_id=reference_id)):
+    ref[rec['step']] = rec['loss']
+  mismatches = []
+  for rec in coll.find(dict(query, experiment_id=experiment_id)).sort('step', 1):
+    step = rec['step']
+    if step in ref and abs(rec['loss'] - ref[step]) > rtol * abs(ref[step]):
+      mismatches.append((step, rec['loss'], ref[step]))
+  return mismatches
@@ -0,0 +1,65 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import threading
+
+import six
+from six.moves import queue, xrange
+
+
+class BatchPrefetcher(object):
+  """Fetches batches for upcoming training steps on a background thread.
+
+  Batches are requested strictly in step order, so a run resumed at a given
+  step issues exactly the same sequence of data_func calls as the synchronous
+  loop in base.run.  At most `depth` batches are held in memory at once.
+  """
+  def __init__(self, data_func, data_func_kwargs, batch_size,
+               start_step, end_step, depth=2):
+    self.data_func = data_func
+    self.data_func_kwargs = data_func_kwargs
+    self.batch_size = batch_size
+    self.start_step = start_step
+    self.end_step = end_step
+    self.queue = queue.Queue(maxsize=depth)
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self.work)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def work(self):
+    try:
+      for step in xrange(self.start_step, self.end_step):
+        batch = self.data_func(step, self.batch_size, **self.data_func_kwargs)
+        if not self.put((step, batch, None)):
+          return
+    except Exception:
+      self.put((None, None, sys.exc_info()))
+
+  def put(self, item):
+    while not self.stopped.is_set():
+      try:
+        self.queue.put(item, timeout=0.1)
+      except queue.Full:
+        continue
+      else:
+        return True
+    return False
+
+  def get(self, step):
+    fetched_step, batch, exc_info = self.queue.get()
+    if exc_info is not None:
+      six.reraise(*exc_info)
+    assert fetched_step == step, (fetched_step, step)
+    return batch
+
+  def close(self):
+    self.stopped.set()
+    while True:
+      try:
+        self.queue.get_nowait()
+      except queue.Empty:
+        break
+    self.thread.join(timeout=1)
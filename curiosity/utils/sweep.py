@@ -0,0 +1,254 @@
+"""
+parallel scheduler for sweeps of base.run trials
+
+A trial is a dict with a unique 'name' and the base.run keyword arguments
+under 'kwargs', with model_func and data_func given as import paths.  Its
+experiment_id is '<name>_learningrate:<base_learningrate>', unless the trial
+gives an 'experiment_id_format' taking the learning rate instead.  Trials
+run in a pool of long-lived worker processes, one per device slot, so a
+retried trial reuses the worker's interpreter and its data connection.  The
+state of every trial is kept in the <colname>_trials collection.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import copy
+import traceback
+import multiprocessing
+from importlib import import_module
+
+import pymongo as pm
+import tensorflow as tf
+
+from curiosity.utils import base, error
+
+
+def import_func(path):
+  module, obj = path.rsplit('.', 1)
+  return getattr(import_module(module), obj)
+
+
+def get_experiment_id(trial):
+  learningrate = trial['kwargs']['base_learningrate']
+  if 'experiment_id_format' in trial:
+    return trial['experiment_id_format'] % learningrate
+  return '%s_learningrate:%f' % (trial['name'], learningrate)
+
+
+def update_trial(tcoll, name, fields):
+  if hasattr(tcoll, 'update_one'):
+    tcoll.update_one({'name': name}, {'$set': fields}, upsert=True)
+  else:
+    tcoll.update({'name': name}, {'$set': fields}, upsert=True)
+
+
+def run_trial(trial):
+  kwargs = copy.deepcopy(trial['kwargs'])
+  kwargs['model_func'] = import_func(kwargs['model_func'])
+  kwargs['data_func'] = import_func(kwargs['data_func'])
+  with tf.Graph().as_default():
+    base.run(experiment_id=trial['experiment_id'], **kwargs)
+
+
+def worker(device, jobs, results):
+  if device is not None:
+    os.environ['CUDA_VISIBLE_DEVICES'] = str(device)
+  while True:
+    trial = jobs.get()
+    if trial is None:
+      return
+    try:
+      run_trial(trial)
+    except error.HiLossError as e:
+      results.put((device, trial, 'diverged', str(e)))
+    except Exception:
+      results.put((device, trial, 'failed', traceback.format_exc()))
+    else:
+      results.put((device, trial, 'done', None))
+
+
+class RetryController(object):
+  """
+  Runs every trial once, in order.  A trial that diverges is queued again
+  with its learning rate multiplied by lr_factor, at most max_retries times.
+  """
+  def __init__(self, trials, lr_factor=0.5, max_retries=10):
+    self.queue = list(trials)
+    self.lr_factor = lr_factor
+    self.max_retries = max_retries
+
+  def next_trial(self):
+    if self.queue:
+      return self.queue.pop(0)
+
+  def report(self, trial, status):
+    if status == 'diverged' and trial.get('attempt', 0) < self.max_retries:
+      trial = copy.deepcopy(trial)
+      trial['kwargs']['base_learningrate'] *= self.lr_factor
+      trial['attempt'] = trial.get('attempt', 0) + 1
+      self.queue.insert(0, trial)
+
+
+def get_recorded_status(tcoll, trial):
+  """
+  Reconciles trial with its record from an earlier invocation of the sweep:
+  a later retry attempt is picked up with its learning rate, and a finished
+  attempt is not run again.  Returns the recorded outcome, or None if the
+  trial has to run.
+  """
+  doc = tcoll.find_one({'name': trial['name']})
+  if doc is None:
+    return None
+  if doc['attempt'] > trial.get('attempt', 0):
+    trial['attempt'] = doc['attempt']
+    trial['kwargs']['base_learningrate'] = doc['learning_rate']
+  if doc['attempt'] != trial.get('attempt', 0):
+    return None
+  if doc['state'] == 'diverged':
+    return 'diverged'
+  if doc['state'] == 'done' and \
+     doc['num_train_steps'] >= trial['kwargs']['num_train_steps']:
+    return 'done'
+  return None
+
+
+def run_sweep(dbname, colname, controller, devices, host='localhost', port=29101):
+  """
+  Runs the trials handed out by controller on one worker per entry of
+  devices (a CUDA device id, or None to leave the device choice alone), and
+  reports each outcome ('done', 'diverged' or 'failed') back to it.
+  """
+  conn = pm.MongoClient(host, port)
+  tcoll = conn[dbname][colname + '_trials']
+  jobs = multiprocessing.Queue()
+  results = multiprocessing.Queue()
+  workers = []
+  for device in devices:
+    w = multiprocessing.Process(target=worker, args=(device, jobs, results))
+    w.daemon = True
+    w.start()
+    workers.append(w)
+
+  num_running = 0
+  try:
+    while True:
+      while num_running < len(devices):
+        trial = controller.next_trial()
+        if trial is None:
+          break
+        trial = copy.deepcopy(trial)
+        status = get_recorded_status(tcoll, trial)
+        if status is not None:
+          controller.report(trial, status)
+          continue
+        trial['experiment_id'] = get_experiment_id(trial)
+        update_trial(tcoll, trial['name'],
+                     {'state': 'running',
+                      'experiment_id': trial['experiment_id'],
+                      'learning_rate': trial['kwargs']['base_learningrate'],
+                      'num_train_steps': trial['kwargs']['num_train_steps'],
+                      'attempt': trial.get('attempt', 0),
+                      'kwargs': trial['kwargs']})
+        jobs.put(trial)
+        num_running += 1
+      if num_running == 0:
+        break
+      device, trial, status, info = results.get()
+      num_running -= 1
+      print('Trial %s finished on device %s: %s' % (trial['experiment_id'], device, status))
+      update_trial(tcoll, trial['name'], {'state': status, 'info': info})
+      controller.report(trial, status)
+  finally:
+    for w in workers:
+      jobs.put(None)
+    for w in workers:
+      w.join()
+
+
+class SuccessiveHalving(object):
+  """
+  Asynchronous successive halving (ASHA).  Rung k trains to min_steps * eta**k
+  steps, capped at max_steps.  New trials start on rung 0; whenever a slot
+  frees up, a trial that finished rung k is promoted to rung k + 1 if its loss
+  is in the top 1 / eta of all trials that finished rung k so far, and
+  otherwise stays paused there.  Promoted trials keep their experiment_id, so
+  base.run resumes them from their latest saved_filters checkpoint.
+
+  The loss of a trial at a rung is the mean of the last loss_window losses
+  base.run recorded in Mongo up to the rung's step.  Rung steps must be
+  multiples of test_frequency * save_multiple, so that a checkpoint is saved
+  at the end of every rung.  Diverging trials are restarted from rung 0 with
+  a reduced learning rate like in RetryController, and are ranked last once
+  their retries are used up.
+  """
+  def __init__(self, trials, min_steps, max_steps, eta=3, loss_window=5,
+               lr_factor=0.5, max_retries=3, host='localhost', port=29101):
+    self.pending = list(trials)
+    self.min_steps = min_steps
+    self.max_steps = max_steps
+    self.eta = eta
+    self.loss_window = loss_window
+    self.lr_factor = lr_factor
+    self.max_retries = max_retries
+    self.conn = pm.MongoClient(host, port)
+    self.num_rungs = 1
+    while self.get_rung_steps(self.num_rungs - 1) < max_steps:
+      self.num_rungs += 1
+    self.completed = [[] for _ in range(self.num_rungs)]
+    self.promoted = [set() for _ in range(self.num_rungs)]
+    self.trials = {}
+
+  def get_rung_steps(self, rung):
+    return min(self.min_steps * self.eta ** rung, self.max_steps)
+
+  def at_rung(self, trial, rung):
+    trial = copy.deepcopy(trial)
+    trial['rung'] = rung
+    kwargs = trial['kwargs']
+    steps = self.get_rung_steps(rung)
+    save_every = kwargs.get('test_frequency', 20) * kwargs.get('save_multiple', 1)
+    assert steps % save_every == 0, (trial['name'], steps, save_every)
+    # base.run trains through step num_train_steps // batch_size - 1
+    kwargs['num_train_steps'] = (steps + 1) * kwargs['batch_size']
+    return trial
+
+  def next_trial(self):
+    for rung in reversed(range(self.num_rungs - 1)):
+      completed = sorted(self.completed[rung])
+      for loss, name in completed[:len(completed) // self.eta]:
+        if name not in self.promoted[rung]:
+          self.promoted[rung].add(name)
+          return self.at_rung(self.trials[name], rung + 1)
+    if self.pending:
+      trial = self.pending.pop(0)
+      return self.at_rung(trial, trial.get('rung', 0))
+
+  def get_loss(self, trial):
+    kwargs = trial['kwargs']
+    coll = self.conn[kwargs['dbname']][kwargs['colname']]
+    recs = coll.find({'experiment_id': get_experiment_id(trial),
+                      'step': {'$lte': self.get_rung_steps(trial['rung'])},
+                      'loss': {'$exists': True}})
+    recs = recs.sort('step', pm.DESCENDING).limit(self.loss_window)
+    losses = [r['loss'] for r in recs]
+    if not losses:
+      return float('inf')
+    return sum(losses) / len(losses)
+
+  def report(self, trial, status):
+    name = trial['name']
+    rung = trial['rung']
+    if status == 'done':
+      self.trials[name] = trial
+      self.completed[rung].append((self.get_loss(trial), name))
+    elif status == 'diverged' and trial.get('attempt', 0) < self.max_retries:
+      trial = copy.deepcopy(trial)
+      trial['kwargs']['base_learningrate'] *= self.lr_factor
+      trial['attempt'] = trial.get('attempt', 0) + 1
+      trial['rung'] = 0
+      self.pending.insert(0, trial)
+    else:
+      self.trials[name] = trial
+      self.completed[rung].append((float('inf'), name))
@@ -0,0 +1,66 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class PhaseTimer(object):
+  """Rolling wall-clock timings of the phases of a training step.
+
+  The last `window` durations of each phase are kept, and summary() reports
+  their mean and percentiles in seconds, ready to store in a Mongo record.
+  """
+  def __init__(self, window=100, percentiles=(50, 90, 99)):
+    self.window = window
+    self.percentiles = percentiles
+    self.times = {}
+
+  @contextmanager
+  def phase(self, name):
+    t0 = time.time()
+    try:
+      yield
+    finally:
+      self.add(name, time.time() - t0)
+
+  def add(self, name, duration):
+    if name not in self.times:
+      self.times[name] = deque(maxlen=self.window)
+    self.times[name].append(duration)
+
+  def summary(self):
+    summary = {}
+    for name, times in self.times.items():
+      times = np.array(times)
+      rec = {'last': float(times[-1]),
+             'mean': float(times.mean())}
+      for p in self.percentiles:
+        rec['p%d' % p] = float(np.percentile(times, p))
+      summary[name] = rec
+    return summary
+
+
+def save_run_metadata(dirn, step, run_metadata):
+  """
+  Writes a TensorFlow RunMetadata trace for step to <dirn>/traces, as the
+  serialized proto and, when the timeline module is available, as a Chrome
+  trace (open it at chrome://tracing).
+  """
+  tdir = os.path.join(dirn, 'traces')
+  if not os.path.exists(tdir):
+    os.makedirs(tdir)
+  with open(os.path.join(tdir, 'run_metadata_%d.pb' % step), 'wb') as _f:
+    _f.write(run_metadata.SerializeToString())
+  try:
+    from tensorflow.python.client import timeline
+  except ImportError:
+    return
+  trace = timeline.Timeline(run_metadata.step_stats)
+  with open(os.path.join(tdir, 'timeline_%d.json' % step), 'w') as _f:
+    _f.write(trace.generate_chrome_trace_format())
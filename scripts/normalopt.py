@@ -1,9 +1,57 @@
 import os
 import pymongo as pm
-conn = pm.MongoClient(port=29101)
+
+from curiosity.utils.sweep import RetryController, SuccessiveHalving, run_sweep
+
+# sandbox scripts whose model and datasource are ported to base.run, as
+# (model_func, data_func); the others are still run as scripts
+PORTED_SCRIPTS = {
+    'normal_encoder_opt_source.py':
+        ('curiosity.models.normal_encoder_asymmetric_with_bypass.get_model',
+         'curiosity.datasources.images_and_normals.getNextBatch'),
+}
 
 num_tries = 10
-def main(ind, dbname, colname, srcdir, savedir, gpu=0, script='normal_encoder_opt_source.py', decayrate=0.95, decaystep=100000):
+def main(ind, dbname, colname, srcdir, savedir, gpu=0, script='normal_encoder_opt_source.py',
+         decayrate=0.95, decaystep=100000, devices=None, num_train_steps=2048000,
+         batch_size=64, erase_earlier=0, host='18.93.3.135', port=23042,
+         datapath='/data2/datasource6', min_steps=None, eta=3):
+    if script not in PORTED_SCRIPTS:
+        run_script(ind, dbname, colname, srcdir, savedir, gpu, script, decayrate, decaystep)
+        return
+    model_func, data_func = PORTED_SCRIPTS[script]
+    if devices is None:
+        devices = (gpu,)
+    data_kwargs = {'host': host, 'port': port, 'datapath': datapath}
+    trials = []
+    for n in range(num_tries):
+        seed = ind * num_tries + n
+        trials.append({'name': "seed:%d_decaystep:%d_decayrate:%f" % (seed, decaystep, decayrate),
+                       'experiment_id_format': "seed:%d_learningrate:%%f_decaystep:%d_decayrate:%f" % (seed, decaystep, decayrate),
+                       'kwargs': {'dbname': dbname,
+                                  'colname': colname,
+                                  'model_func': model_func,
+                                  'model_func_kwargs': data_kwargs,
+                                  'data_func': data_func,
+                                  'data_func_kwargs': data_kwargs,
+                                  'num_train_steps': num_train_steps,
+                                  'batch_size': batch_size,
+                                  'seed': seed,
+                                  'savedir': savedir,
+                                  'base_learningrate': 1.,
+                                  'decaystep': decaystep,
+                                  'decayrate': decayrate,
+                                  'erase_earlier': erase_earlier}})
+    if min_steps is None:
+        controller = RetryController(trials, lr_factor=0.5, max_retries=9)
+    else:
+        controller = SuccessiveHalving(trials, min_steps, num_train_steps // batch_size,
+                                       eta=eta, lr_factor=0.5, max_retries=9)
+    run_sweep(dbname, colname, controller, list(devices))
+
+
+def run_script(ind, dbname, colname, srcdir, savedir, gpu, script, decayrate, decaystep):
+    conn = pm.MongoClient(port=29101)
     for n in range(num_tries):
         learningrate = 1.
         print('reset learning rate to %f' % learningrate)
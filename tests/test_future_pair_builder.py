@@ -0,0 +1,79 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+
+from curiosity.datasources.future_pair_builder import (get_episode_ids,
+                                                       get_valid_pairs)
+
+
+def make_batch_info(bn, batch_size):
+  """
+  The infolist datasource_actions_motion.make_new_batch_locked saves for
+  batch bn: the message sent after frame 0 teleports, the others turn,
+  move or push an object.
+  """
+  infolist = []
+  for i in range(batch_size):
+    msg = {'msg_type': 'CLIENT_INPUT',
+           'get_obj_data': False,
+           'actions': []}
+    if i == 0:
+      if bn == 0:
+        msg['get_obj_data'] = True
+      msg['teleport_random'] = True
+    elif i % 3 == 0:
+      msg['ang_vel'] = [0, 1.5, 0]
+      msg['vel'] = [0, 0, -0.5]
+    else:
+      msg['vel'] = [0, 0, .25]
+      msg['ang_vel'] = [0, 0, 0]
+      msg['actions'].append({'id': '7',
+                             'force': [5, 30, 0],
+                             'torque': [0, 2.5, 0],
+                             'action_pos': [120., 131.]})
+    infolist.append(msg)
+  return infolist
+
+
+class EpisodeTest(unittest.TestCase):
+
+  def setUp(self):
+    self.batch_size = 8
+    self.info = make_batch_info(0, self.batch_size) + make_batch_info(1, self.batch_size)
+    self.teleport = [x.get('teleport_random', False) for x in self.info]
+
+  def test_flagged_frame_ends_its_episode(self):
+    episode_ids = get_episode_ids(self.teleport)
+    # frame 0 is the last frame before the first teleport, frame 8 (frame 0
+    # of batch 1) the last of the episode that frames 1 .. 7 start
+    self.assertEqual(episode_ids.tolist(), [0] + [1] * 8 + [2] * 7)
+
+  def test_valid_change_starts_episode(self):
+    valid = np.ones(len(self.info), dtype=np.bool_)
+    valid[12:] = False
+    episode_ids = get_episode_ids(self.teleport, valid)
+    self.assertEqual(episode_ids.tolist(), [0] + [1] * 8 + [2] * 3 + [3] * 4)
+
+  def test_pairs_stay_within_episodes(self):
+    episode_ids = get_episode_ids(self.teleport)
+    inds, futures = get_valid_pairs(episode_ids, 10, observation_length=2)
+    pairs = set(zip(inds.tolist(), futures.tolist()))
+    flagged = [i for i, t in enumerate(self.teleport) if t]
+    for i, t in pairs:
+      # no teleport between the first observed frame and the future frame
+      self.assertFalse([f for f in flagged if i - 1 <= f < t], (i, t))
+    # the observation of i = 1 would stack frames 0 and 1 across the teleport
+    self.assertNotIn(1, inds.tolist())
+    # a pair may end on the flagged frame, the last of its episode
+    self.assertIn((2, 8), pairs)
+    self.assertIn((7, 8), pairs)
+    self.assertNotIn((8, 9), pairs)
+    self.assertNotIn((7, 9), pairs)
+
+
+if __name__ == '__main__':
+  unittest.main()
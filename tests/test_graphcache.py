@@ -0,0 +1,48 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from curiosity.models import builder
+from curiosity.models import normal_encoder_asymmetric_with_bypass as model_module
+from curiosity.utils import graphcache
+
+
+class GraphKeyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.builder_file = builder.__file__
+
+  def tearDown(self):
+    builder.__file__ = self.builder_file
+    shutil.rmtree(self.tmpdir)
+
+  def get_key(self):
+    return graphcache.get_graph_key(model_module.get_model, {'host': 'localhost'},
+                                    64, {'encode_depth': 2})
+
+  def test_model_module_uses_builder(self):
+    deps = graphcache.get_module_deps(model_module.__name__)
+    self.assertIn(model_module.__name__, deps)
+    self.assertIn(builder.__name__, deps)
+
+  def test_builder_change_invalidates_key(self):
+    key = self.get_key()
+    self.assertEqual(key, self.get_key())
+    path = os.path.join(self.tmpdir, 'builder.py')
+    with open(path, 'wb') as f:
+      f.write(graphcache.get_module_source(builder.__name__))
+    builder.__file__ = path
+    self.assertEqual(key, self.get_key())
+    with open(path, 'ab') as f:
+      f.write(b'\n\ndef conv2(*args):\n  return conv(*args)\n')
+    self.assertNotEqual(key, self.get_key())
+
+
+if __name__ == '__main__':
+  unittest.main()